@@ -0,0 +1,103 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+pytz
+requests
+"""
+
+import json
+import os
+from functools import lru_cache
+from threading import Lock
+import pytz
+
+# Set to "false" to never fall back to openflights.org for unknown codes
+REMOTE_FALLBACK = os.environ.get('AIRPORT_TZ_REMOTE_FALLBACK', 'true').lower() != 'false'
+OPENFLIGHTS_URL = "https://openflights.org/php/apsearch.php"
+
+# Bundled IATA -> tz database index, grouped by zone to keep it compact.
+# Generated from Southwest's published route map; regenerate it whenever
+# stations open or close, since anything missing falls through to the
+# blocking remote lookup (when enabled) and is only remembered for the life
+# of the process.
+_AIRPORT_TZ_DATA = """
+America/New_York: ALB ATL BDL BOS BUF BWI CHS CLE CLT CMH CVG DAB DCA EWR EYW FLL GSP IAD ISP JAX LGA MCO MHT MIA MYR ORF PBI PHL PIT PVD PWM RDU RIC ROC RSW SAV SRQ SYR TPA
+America/Detroit: DTW GRR
+America/Indiana/Indianapolis: IND
+America/Kentucky/Louisville: SDF
+America/Chicago: AMA AUS BHM BNA CRP DAL DSM ECP HOU HRL IAH ICT JAN LBB LIT MAF MCI MDW MEM MKE MSP MSY OKC OMA ORD PNS SAT STL TUL VPS
+America/Denver: ABQ BZN COS DEN ELP HDN MTJ SLC
+America/Boise: BOI
+America/Phoenix: PHX TUS
+America/Los_Angeles: BLI BUR EUG FAT GEG LAS LAX LGB OAK ONT PDX PSP RNO SAN SBA SEA SFO SJC SMF SNA STS
+Pacific/Honolulu: HNL ITO KOA LIH OGG
+America/Puerto_Rico: SJU
+America/St_Thomas: STT
+America/Aruba: AUA
+America/Belize: BZE
+America/Cancun: CUN CZM
+America/Cayman: GCM
+America/Costa_Rica: LIR SJO
+America/Havana: HAV
+America/Jamaica: MBJ
+America/Mazatlan: SJD
+America/Bahia_Banderas: PVR
+America/Mexico_City: MEX
+America/Nassau: NAS
+America/Santo_Domingo: PUJ
+"""
+
+_index = None
+_index_lock = Lock()
+
+
+def _load_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = {}
+                for line in _AIRPORT_TZ_DATA.strip().splitlines():
+                    tz_id, codes = line.split(':', 1)
+                    for code in codes.split():
+                        index[code] = tz_id
+                _index = index
+    return _index
+
+
+@lru_cache(maxsize=None)
+def _zone(tz_id):
+    return pytz.timezone(tz_id)
+
+
+def _remote_tz_id(airport_code):
+    # Only pay for requests when we actually need to go over the network
+    import http_sessions
+    tzrequest = {'iata': airport_code,
+                 'country': 'ALL',
+                 'db': 'airports',
+                 'iatafilter': 'true',
+                 'action': 'SEARCH',
+                 'offset': '0'}
+    tzresult = http_sessions.get_session('openflights').post(OPENFLIGHTS_URL, tzrequest)
+    return json.loads(tzresult.text)['airports'][0]['tz_id']
+
+
+def tz_id_for_airport(airport_code, remote_fallback=None):
+    code = airport_code.strip().upper()
+    index = _load_index()
+    tz_id = index.get(code)
+    if tz_id is None:
+        if remote_fallback is None:
+            remote_fallback = REMOTE_FALLBACK
+        if not remote_fallback:
+            raise KeyError("No bundled timezone for airport {}".format(code))
+        print("Airport {} not in bundled index, asking openflights.org".format(code))
+        tz_id = _remote_tz_id(code)
+        index[code] = tz_id
+    return tz_id
+
+
+def timezone_for_airport(airport_code, remote_fallback=None):
+    return _zone(tz_id_for_airport(airport_code, remote_fallback))
@@ -0,0 +1,145 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+firebase_admin
+"""
+
+# Backfill Reservations from historical confirmation emails.
+#
+# Streams an mbox file, or a JSONL file of CloudMailin payloads (one
+# {"headers": {"subject": ...}, "plain": ...} object per line), through the
+# same parser as on_incoming_message(). Parsing runs in a process pool and
+# writes go to Firestore in batches, together with the dedupe markers that
+# stop later forwards of the same reservation being stored again.
+#
+#   python bulk_ingestion.py emails.mbox
+#   python bulk_ingestion.py emails.jsonl --workers 8 --dry-run
+
+import argparse
+import email
+import email.policy
+import json
+import mailbox
+import os
+from itertools import islice
+from multiprocessing import Pool
+import dedupe
+import email_rules
+import gcp_clients
+
+# Emails handed to the pool at a time; bounds memory on very large files
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 2000))
+
+
+def mbox_payloads(path):
+    box = mailbox.mbox(path, create=False)
+    try:
+        for key in box.iterkeys():
+            yield 'mbox', box.get_bytes(key)
+    finally:
+        box.close()
+
+
+def jsonl_payloads(path):
+    with open(path, 'r') as lines:
+        for line in lines:
+            if line.strip():
+                yield 'jsonl', line
+
+
+def _mbox_fields(raw):
+    message = email.message_from_bytes(raw, policy=email.policy.default)
+    body = message.get_body(preferencelist=('plain',))
+    return message['subject'] or '', email_rules.cap_body(body.get_content()) if body is not None else ''
+
+
+def _jsonl_fields(raw):
+    request_json = json.loads(raw)
+    return request_json['headers']['subject'], email_rules.cap_body(request_json.get('plain'))
+
+
+def parse_payload(payload):
+    # Runs in the worker processes
+    kind, raw = payload
+    try:
+        subject, body = _mbox_fields(raw) if kind == 'mbox' else _jsonl_fields(raw)
+    except Exception as e:
+        return 'failed', None, "unreadable email: {!r}".format(e)
+    parsed = email_rules.classify(subject, body)
+    if not all([parsed.fname, parsed.lname, parsed.reservation]):
+        return 'failed', None, subject
+    return 'parsed', (parsed.fname, parsed.lname, parsed.reservation), subject
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ingest(payloads, workers=None, dry_run=False, verbose=False):
+    """ Parse and store a stream of emails.
+    Args:
+        payloads (iterable): (kind, raw) pairs from mbox_payloads or jsonl_payloads.
+        workers (int): Parser processes, defaults to one per CPU.
+        dry_run (bool): Parse and count but don't write to Firestore.
+    Returns:
+        dict: parsed, failed, duplicate and written counts.
+    """
+    summary = {'emails': 0, 'parsed': 0, 'failed': 0, 'duplicate': 0, 'written': 0}
+    seen = set()
+    db = None if dry_run else gcp_clients.firestore_client()
+    with Pool(workers) as pool:
+        for chunk in _chunks(payloads, BULK_CHUNK_SIZE):
+            # dedupe key -> (document_id, data) still to be written
+            candidates = {}
+            for status, fields, subject in pool.imap(parse_payload, chunk, chunksize=64):
+                summary['emails'] += 1
+                if status != 'parsed':
+                    summary['failed'] += 1
+                    if verbose:
+                        print("Unable to find reservation for {}".format(subject))
+                    continue
+                summary['parsed'] += 1
+                document_id, data = email_rules.reservation_record(*fields)
+                if document_id in seen:
+                    summary['duplicate'] += 1
+                    continue
+                seen.add(document_id)
+                fname, lname, reservation = fields
+                candidates[dedupe.reservation_key(reservation, fname, lname)] = (document_id, data)
+            if db is not None:
+                # Reservations already ingested live (or by an earlier backfill)
+                # are left alone, so retrieve_from_firestore doesn't run again
+                unclaimed, writes = dedupe.claim_many(db, candidates)
+                summary['duplicate'] += len(candidates) - len(unclaimed)
+                for key in unclaimed:
+                    document_id, data = candidates[key]
+                    writes.append((db.collection(u'Reservations').document(document_id), data))
+                gcp_clients.write_documents(db, writes)
+                summary['written'] += len(unclaimed)
+            print("Processed {emails} emails: {parsed} parsed, {failed} failed, {duplicate} duplicates".format(**summary))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill Reservations from an mbox or JSONL export of confirmation emails.")
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=('mbox', 'jsonl'), help="Defaults to the file extension")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    kind = args.format or ('jsonl' if args.path.endswith(('.jsonl', '.json')) else 'mbox')
+    payloads = jsonl_payloads(args.path) if kind == 'jsonl' else mbox_payloads(args.path)
+    summary = ingest(payloads, args.workers, args.dry_run, args.verbose)
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,24 +8,43 @@ pycodestyle
 pytest
 pytest-cov
 pytest-mock
-python-dateutil
-pytz
 firebase_admin
 google-cloud-pubsub
+requests
 """
 
 import base64
 import json
+import os
+from collections import OrderedDict
+from concurrent import futures
 from datetime import datetime
 from datetime import timedelta
-from dateutil.parser import parse
-import pytz
-import sys
+from datetime import timezone
 from time import sleep
-import firebase_admin
-from firebase_admin import credentials
 from firebase_admin import firestore
 from google.cloud import pubsub_v1
+import server_clock
+import gcp_clients
+
+# Publisher batching, see google.cloud.pubsub_v1.types.BatchSettings
+PUBLISH_BATCH_MAX_MESSAGES = int(os.environ.get('PUBSUB_BATCH_MAX_MESSAGES', 100))
+PUBLISH_BATCH_MAX_BYTES = int(os.environ.get('PUBSUB_BATCH_MAX_BYTES', 1024 * 1024))
+PUBLISH_BATCH_MAX_LATENCY = float(os.environ.get('PUBSUB_BATCH_MAX_LATENCY', 0.05))
+# How long to wait for the whole batch before reporting stragglers as failed
+PUBLISH_TIMEOUT_SECONDS = float(os.environ.get('PUBSUB_PUBLISH_TIMEOUT_SECONDS', 30))
+# Where the dispatcher keeps its high-water mark between ticks
+DISPATCHER_COLLECTION = u'Dispatcher'
+DISPATCHER_DOCUMENT = u'flights'
+# Flights are read in pages of this size when catching up
+DISPATCH_PAGE_SIZE = int(os.environ.get('DISPATCH_PAGE_SIZE', 200))
+# How far back a tick catches up when the watermark is very stale
+DISPATCH_MAX_CATCHUP = timedelta(hours=float(os.environ.get('DISPATCH_MAX_CATCHUP_HOURS', 6)))
+# A claim whose publish was never confirmed can be taken over after this
+# long, so a tick that dies mid-dispatch can't strand its flights
+DISPATCH_LEASE = timedelta(seconds=float(os.environ.get('DISPATCH_LEASE_SECONDS', 300)))
+# Bookkeeping fields that are not forwarded to the check-in function
+DISPATCH_FIELDS = (u'checkin_time', u'dispatched', u'dispatched_at', u'dispatch_lease_expires', u'cancelled', u'dead_strikes', u'revalidated_at')
 
 def base64decoder(encoded_data):
     decoded_string = base64.b64decode(encoded_data)
@@ -33,11 +52,131 @@ def base64decoder(encoded_data):
     return decoded_string
     
 
+def due_flights(db, start, end):
+    # Page through Flights checking in between start and end, oldest first
+    query = db.collection(u'Flights').where(u'checkin_time', u'>=', start).where(u'checkin_time', u'<=', end).order_by(u'checkin_time').limit(DISPATCH_PAGE_SIZE)
+    last = None
+    while True:
+        page = query if last is None else query.start_after(last)
+        snapshots = list(page.stream())
+        for snapshot in snapshots:
+            yield snapshot
+        if len(snapshots) < DISPATCH_PAGE_SIZE:
+            return
+        last = snapshots[-1]
+
+
+def claimable(data, now):
+    # Not yet dispatched, or claimed by a tick that never confirmed its publish
+    if not data or data.get(u'cancelled'):
+        # Flagged dead by revalidate_flights; nothing to check in
+        return False
+    if not data.get(u'dispatched'):
+        return True
+    lease = data.get(u'dispatch_lease_expires')
+    return lease is not None and lease <= now
+
+
+@firestore.transactional
+def claim_flight(transaction, doc_ref, now):
+    # Only one tick gets to dispatch a flight, however much they overlap.
+    # The claim is a lease until settle_claims confirms the publish.
+    snapshot = doc_ref.get(transaction=transaction)
+    data = snapshot.to_dict() if snapshot.exists else None
+    if not claimable(data, now):
+        return None
+    transaction.update(doc_ref, {u'dispatched': True, u'dispatched_at': firestore.SERVER_TIMESTAMP, u'dispatch_lease_expires': now + DISPATCH_LEASE})
+    return data
+
+
+def release_claims(group):
+    # Hand the flights back so the next tick retries them; if this fails
+    # too, the lease hands them back once it expires
+    for flight in group[u'flights']:
+        try:
+            flight.reference.update({u'dispatched': False, u'dispatch_lease_expires': None})
+        except Exception as e:
+            print("Unable to release {}: {!r}".format(flight.id, e))
+
+
+def settle_late(db, group, future):
+    # Done callback for a publish that outlived PUBLISH_TIMEOUT_SECONDS,
+    # settled the same way as the rest once it resolves
+    flight_ids = ", ".join(flight.id for flight in group[u'flights'])
+    try:
+        print("Published {} late as message {}".format(flight_ids, future.result()))
+    except Exception as e:
+        print("Failed to publish {}: {!r}".format(flight_ids, e))
+        release_claims(group)
+        return
+    batch = db.batch()
+    for flight in group[u'flights']:
+        batch.update(flight.reference, {u'dispatch_lease_expires': None})
+    try:
+        batch.commit()
+    except Exception as e:
+        print("Unable to confirm {}: {!r}".format(flight_ids, e))
+
+
+def settle_claims(db, groups):
+    """ Confirm the claims whose message went out and release the rest.
+    A publish still in flight keeps its lease rather than being released,
+    since it can still go out and a released flight would be sent twice;
+    it is settled by settle_late once it resolves.
+    Returns:
+        tuple: (published, failed, in_flight) lists of groups.
+    """
+    published, failed, in_flight = [], [], []
+    for group in groups:
+        flight_ids = ", ".join(flight.id for flight in group[u'flights'])
+        future = group.get(u'future')
+        if future is not None and not future.done():
+            in_flight.append(group)
+            print("Publish of {} still pending, settling it once it resolves".format(flight_ids))
+            future.add_done_callback(lambda future, group=group: settle_late(db, group, future))
+            continue
+        try:
+            if future is None:
+                raise RuntimeError("never published")
+            print("Published {} as message {}".format(flight_ids, future.result(timeout=0)))
+            published.append(group)
+        except Exception as e:
+            failed.append(group)
+            print("Failed to publish {}: {!r}".format(flight_ids, e))
+
+    # Published for good: drop the leases so no later tick takes them over
+    flights = [flight for group in published for flight in group[u'flights']]
+    for start in range(0, len(flights), gcp_clients.MAX_BATCH_WRITES):
+        batch = db.batch()
+        for flight in flights[start:start + gcp_clients.MAX_BATCH_WRITES]:
+            batch.update(flight.reference, {u'dispatch_lease_expires': None})
+        batch.commit()
+    for group in failed:
+        release_claims(group)
+    return published, failed, in_flight
+
+
+def read_watermark(db):
+    snapshot = db.collection(DISPATCHER_COLLECTION).document(DISPATCHER_DOCUMENT).get()
+    if not snapshot.exists:
+        return None
+    return (snapshot.to_dict() or {}).get(u'high_water_mark')
+
+
+@firestore.transactional
+def advance_watermark(transaction, doc_ref, mark):
+    # Never move backwards if a slower, overlapping tick finishes after us
+    snapshot = doc_ref.get(transaction=transaction)
+    current = (snapshot.to_dict() or {}).get(u'high_water_mark') if snapshot.exists else None
+    if current is None or mark > current:
+        transaction.set(doc_ref, {u'high_water_mark': mark}, merge=True)
+
 
 def find_flights(event, context):
     try:
-        # Set current time to compare against flight records
-        current_time=datetime.utcnow()
+        # Set current time to compare against flight records, on Southwest's clock
+        server_clock.calibrate()
+        current_time=server_clock.server_utcnow().replace(tzinfo=timezone.utc)
         # Move forward one minute to check within the next minute
         current_time_plus1=current_time + timedelta(minutes=1)        
 
@@ -49,42 +188,105 @@ def find_flights(event, context):
         else:
             print("Cloud Scheduler sent unidentified data.")
 
-        if not firebase_admin._apps:
-            firebase_admin.initialize_app()
-        db = firestore.client()
+        db = gcp_clients.firestore_client()
 
-        flights = db.collection(u'Flights').where(u'checkin_time', u'>=', current_time).where(u'checkin_time', u'<=', current_time_plus1).stream()
+        # Pick up where the last tick left off, so a late tick catches up
+        # instead of skipping the minutes it missed. The first tick has
+        # nothing to catch up on: anything earlier went out before the
+        # watermark existed, and its documents aren't marked dispatched.
+        watermark = read_watermark(db)
+        if watermark is None:
+            scan_from = current_time
+        else:
+            scan_from = max(watermark, current_time - DISPATCH_MAX_CATCHUP)
+        print("Scanning flights checking in from {} to {}".format(scan_from, current_time_plus1))
 
         # To Do
         project_id = "GCPPROJECT"
         topic_id = "YOURTOPIC"
 
-        publisher = pubsub_v1.PublisherClient()
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=PUBLISH_BATCH_MAX_MESSAGES,
+            max_bytes=PUBLISH_BATCH_MAX_BYTES,
+            max_latency=PUBLISH_BATCH_MAX_LATENCY,
+        )
+        publisher = gcp_clients.publisher_client(batch_settings)
         topic_path = publisher.topic_path(project_id, topic_id)
+        print(gcp_clients.timing_report())
 
 
         flights_detected = False
+        scanned = 0
+        # Passengers on the same PNR checking in at the same instant share
+        # one message and one check-in
+        groups = OrderedDict()
 
-        # For any flights found, send them to Pub/Sub
-        for flight in flights:
-            flights_detected = True
-            del flight._data['checkin_time']
-            flight_json = json.dumps(flight._data)
-            print("Found flight: " + flight.id)
-            message = flight_json
-            # Data must be a bytestring
-            message = message.encode("utf-8")
-            print(message)
-            # When you publish a message, the client returns a future.
-            future = publisher.publish(topic_path, data=message)
-            print(future.result())
+        # Whatever goes wrong below, every claim made so far is settled, so
+        # a failed tick never leaves flights claimed but unsent
+        try:
+            # For any flights found, send them to Pub/Sub
+            for flight in due_flights(db, scan_from, current_time_plus1):
+                scanned += 1
+                if not claimable(flight.to_dict(), current_time):
+                    continue
+                data = claim_flight(db.transaction(), flight.reference, current_time)
+                if data is None:
+                    print("Flight {} already dispatched".format(flight.id))
+                    continue
+                flights_detected = True
+                checkin_time = data[u'checkin_time']
+                for field in DISPATCH_FIELDS:
+                    data.pop(field, None)
+                # The departure snapshot travels as ISO 8601 with its UTC offset
+                for field, value in data.items():
+                    if isinstance(value, datetime):
+                        data[field] = value.isoformat()
+                print("Found flight: " + flight.id)
+                passenger = {u'first_name': data[u'first_name'], u'last_name': data[u'last_name']}
+                key = (data[u'reservation_number'].upper(), checkin_time)
+                if key in groups:
+                    groups[key][u'passengers'].append(passenger)
+                    groups[key][u'flights'].append(flight)
+                else:
+                    data[u'passengers'] = [passenger]
+                    groups[key] = {u'data': data, u'passengers': data[u'passengers'], u'flights': [flight], u'checkin_time': checkin_time}
+
+            print("Read {} flight documents".format(scanned))
+
+            for group in groups.values():
+                flight_json = json.dumps(group[u'data'])
+                message = flight_json
+                # Data must be a bytestring
+                message = message.encode("utf-8")
+                print(message)
+                # Publishing is batched in the background; collect the futures
+                # and wait on all of them once below
+                group[u'future'] = publisher.publish(topic_path, data=message)
+
+            futures.wait([group[u'future'] for group in groups.values()], timeout=PUBLISH_TIMEOUT_SECONDS)
+        finally:
+            published, failed, in_flight = settle_claims(db, groups.values())
+
+        # Everything scanned is done with, so the next tick only reads past
+        # it; failed and unconfirmed publishes hold the watermark back
+        mark = current_time_plus1
+        for group in failed + in_flight:
+            mark = min(mark, group[u'checkin_time'])
+
+        advance_watermark(db.transaction(), db.collection(DISPATCHER_COLLECTION).document(DISPATCHER_DOCUMENT), mark)
 
         if flights_detected == False:
             print("No flights flound")
-
+        else:
+            print("Published {} of {} check-ins covering {} flights, {} still pending".format(
+                len(published), len(groups), sum(len(group[u'flights']) for group in groups.values()), len(in_flight)))
+        if in_flight:
+            # Give late publishes a chance to settle before the instance is
+            # frozen; any that don't are retaken once their lease expires
+            futures.wait([group[u'future'] for group in in_flight], timeout=PUBLISH_TIMEOUT_SECONDS)
 
         return("Checked for flights.")
 
     except Exception as e:
         sleep(8)
-        raise e
\ No newline at end of file
+        raise e
@@ -4,85 +4,151 @@
 # package>=version
 coverage
 datetime
-docopts
 pycodestyle
 pytest
 pytest-cov
 pytest-mock
-python-dateutil
 pytz
 requests
 requests_mock
+aiohttp
 uuid
 vcrpy
-flask
 """
 
+import asyncio
 import base64
-from flask import request
-import requests
 import json
+import os
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
-from dateutil.parser import parse
-from docopt import docopt
 from math import trunc
 import pytz
-from threading import Thread
 import sys
+from time import monotonic
 from time import sleep
-from uuid import uuid1
+from airports import timezone_for_airport
+import southwest_headers
+import http_sessions
+import server_clock
+import rate_limit
+import checkin_trace
+import southwest
+from southwest import CHECKIN_INTERVAL_SECONDS
+from southwest import json_page
+from southwest_errors import ApiKeyUnavailable
+from southwest_errors import DeadlineExceeded
+from southwest_errors import RetriesExhausted
 
+# Only used until the server clock has been calibrated, see server_clock
 CHECKIN_EARLY_SECONDS = 5
-BASE_URL = 'https://mobile.southwest.com/api/'
-CHECKIN_INTERVAL_SECONDS = 0.25
-MAX_ATTEMPTS = 40
+# Longest a single reservation may spend in the check-in engine. Kept inside
+# the function timeout (FUNCTION_TIMEOUT_SEC on Cloud Functions), with room
+# for the error path's sleep, so a check-in is cancelled cleanly and traced
+# rather than killed by the platform
+CHECKIN_DEADLINE_SECONDS = float(os.environ.get('CHECKIN_DEADLINE_SECONDS', int(os.environ.get('FUNCTION_TIMEOUT_SEC', 540)) - 30))
+# Open and authenticate the connection this long before firing
+PREWARM_SECONDS = 3
+# Stop sleeping this long before firing and spin on the monotonic clock
+SPIN_SECONDS = 0.3
+# Retry every CHECKIN_INTERVAL_SECONDS for this long before backing off; a
+# window that isn't open yet usually is a moment later
+RETRY_STEADY_SECONDS = float(os.environ.get('CHECKIN_RETRY_STEADY_SECONDS', 1.0))
+# Hedged mode: send this many staggered single-shot attempts around the
+# opening instant and keep the first confirmation (1 disables hedging)
+HEDGE_ATTEMPTS = int(os.environ.get('CHECKIN_HEDGE_ATTEMPTS', 1))
+HEDGE_STAGGER_SECONDS = float(os.environ.get('CHECKIN_HEDGE_STAGGER_SECONDS', 0.15))
+# How quickly winning offsets pull future fire times, and how far
+HEDGE_LEARNING_RATE = 0.25
+HEDGE_MAX_BIAS_SECONDS = 2.0
 
-class Reservation():
+# Per-process record of which hedge offsets won, kept across warm invocations
+_hedge_stats = {'wins': {}, 'bias': 0.0}
 
-    def __init__(self, number, first, last, verbose=False):
-        self.number = number
-        self.first = first
-        self.last = last
-        self.verbose = verbose
+class Reservation(southwest.ReservationBase):
+
+    def __init__(self, number, first, last, verbose=False, session=None, deadline=None, base_url=None):
+        super(Reservation, self).__init__(number, first, last, verbose, base_url)
+        # aiohttp session shared by every reservation on the event loop
+        self.session = session
+        # Monotonic time after which requests give up instead of retrying
+        self.deadline = deadline
+        # Monotonic time the first check-in request left, see schedule_checkin
+        self.sent_at = None
+        # checkIn link fetched ahead of time by prepare_checkin
+        self.checkin_link = None
+        # Phase timings, a no-op unless CHECKIN_TRACE is set
+        self.trace = checkin_trace.start(number)
 
     @staticmethod
-    def generate_headers():
-        config_js = requests.get('https://mobile.southwest.com/js/config.js')
-        if config_js.status_code == requests.codes.ok:
-            modded = config_js.text[config_js.text.index("API_KEY"):]
-            API_KEY = modded[modded.index(':') + 1:modded.index(',')].strip('"')
-        else:
-            print("Couldn't get API_KEY")
-            sys.exit(1)
+    async def generate_headers():
+        # config.js is only fetched when the shared cache is cold or expired,
+        # and then off the event loop so other check-ins keep running
+        headers = southwest_headers.cached_headers()
+        if headers is None:
+            loop = asyncio.get_running_loop()
+            headers = await loop.run_in_executor(None, southwest_headers.get_headers)
+        if headers is None:
+            raise ApiKeyUnavailable("Couldn't get API_KEY")
+        return headers
 
-        USER_EXPERIENCE_KEY = str(uuid1()).upper()
-        # Pulled from proxying the Southwest iOS App
-        return {'Host': 'mobile.southwest.com', 'Content-Type': 'application/json', 'X-API-Key': API_KEY, 'X-User-Experience-Id': USER_EXPERIENCE_KEY, 'Accept': '*/*', 'X-Channel-ID': 'MWEB'}
+    async def _headers(self):
+        started = self.trace.clock()
+        headers = await Reservation.generate_headers()
+        self.trace.record('generate_headers', started)
+        return headers
+
+    async def _send(self, url, headers, body=None, bucket=None, deadline=None):
+        # Every request to Southwest draws from a process-wide budget: the
+        # shared one, or rate_limit.checkin for requests made while firing
+        bucket = bucket or rate_limit.southwest
+        deadline = min(deadline, self.deadline or deadline) if deadline is not None else self.deadline
+        started = self.trace.clock()
+        await bucket.acquire_async(deadline)
+        self.trace.record('rate_limit_wait', started)
+        if self.sent_at is None:
+            self.sent_at = monotonic()
+        started = self.trace.clock()
+        if body is not None:
+            r = await self.session.post(url, headers=headers, json=body)
+        else:
+            r = await self.session.get(url, headers=headers)
+        async with r:
+            data = await r.json(content_type=None)
+        self.trace.record('request', started)
+        self.trace.attempt(data.get('httpStatusCode', r.status) if isinstance(data, dict) else r.status)
+        if not isinstance(data, dict):
+            # An empty body, e.g. a bare 502 from the edge, is as good as no json
+            raise ValueError("No JSON object in response (HTTP {})".format(r.status))
+        return r, data
 
     # You might ask yourself, "Why the hell does this exist?"
     # Basically, there sometimes appears a "hiccup" in Southwest where things
     # aren't exactly available 24-hours before, so we try a few times
-    def safe_request(self, url, body=None):
+    async def safe_request(self, url, body=None, bucket=None):
         try:
             attempts = 0
-            headers = Reservation.generate_headers()
+            headers = await self._headers()
             while True:
-                if body is not None:
-                    r = requests.post(url, headers=headers, json=body)
-                else:
-                    r = requests.get(url, headers=headers)
-                data = r.json()
-                if 'httpStatusCode' in data and data['httpStatusCode'] in ['NOT_FOUND', 'BAD_REQUEST', 'FORBIDDEN']:
+                r, data = await self._send(url, headers, body, bucket)
+                if 'httpStatusCode' in data and data['httpStatusCode'] in southwest.RETRY_STATUSES:
                     attempts += 1
+                    if data['httpStatusCode'] == 'FORBIDDEN':
+                        # Our cached API key may have been rotated
+                        southwest_headers.invalidate(headers['X-API-Key'])
+                        headers = await self._headers()
                     if not self.verbose:
                         print(data['message'])
                     else:
                         print(r.headers)
                         print(json.dumps(data, indent=2))
-                    if attempts > MAX_ATTEMPTS:
-                        sys.exit("Unable to get data, killing self")
-                    sleep(CHECKIN_INTERVAL_SECONDS)
+                    if attempts > self.max_attempts:
+                        raise RetriesExhausted(url, attempts, data['httpStatusCode'], data.get('message'))
+                    started = self.trace.clock()
+                    steady = int(RETRY_STEADY_SECONDS / CHECKIN_INTERVAL_SECONDS)
+                    await asyncio.sleep(rate_limit.backoff_delay(attempts, CHECKIN_INTERVAL_SECONDS, self.deadline, steady=steady))
+                    self.trace.record('retry_backoff', started)
                     continue
                 if self.verbose:
                     print(r.headers)
@@ -92,52 +158,193 @@ class Reservation():
             # Ignore responses with no json data in body
             pass
 
-    def load_json_page(self, url, body=None):
-        data = self.safe_request(url, body)
-        if not data:
-            return
-        for k, v in list(data.items()):
-            if k.endswith("Page"):
-                return v
+    async def load_json_page(self, url, body=None, bucket=None):
+        data = await self.safe_request(url, body, bucket)
+        return json_page(data)
 
-    def with_suffix(self, uri):
-        return "{}{}{}?first-name={}&last-name={}".format(BASE_URL, uri, self.number, self.first, self.last)
-
-    def lookup_existing_reservation(self):
+    async def lookup_existing_reservation(self):
         # Find our existing record
-        return self.load_json_page(self.with_suffix("mobile-air-booking/v1/mobile-air-booking/page/view-reservation/"))
+        started = self.trace.clock()
+        page = await self.load_json_page(self.with_suffix(southwest.VIEW_RESERVATION_PATH))
+        self.trace.record('lookup_existing_reservation', started)
+        return page
+
+    async def get_checkin_data(self, bucket=None):
+        started = self.trace.clock()
+        page = await self.load_json_page(self.with_suffix(southwest.CHECKIN_PATH), bucket=bucket)
+        self.trace.record('get_checkin_data', started)
+        return page
+
+    async def prewarm(self):
+        # Fill the header cache and open a keep-alive connection so the
+        # first check-in request doesn't pay for config.js or a TLS handshake
+        started = self.trace.clock()
+        await self._headers()
+        try:
+            async with self.session.head(self.base_url):
+                pass
+        except Exception as e:
+            print("Unable to pre-warm connection: {}".format(e))
+        self.trace.record('prewarm', started)
 
-    def get_checkin_data(self):
-        return self.load_json_page(self.with_suffix("mobile-air-operations/v1/mobile-air-operations/page/check-in/"))
+    async def prepare_checkin(self, probe_at, fire_at):
+        # A single look at the check-in page just before firing. Windows
+        # sometimes open a little early, and then firing only needs the POST;
+        # until then the page only answers BAD_REQUEST, so polling for it
+        # would just drain the rate budget the check-in itself needs. The
+        # probe is dropped at fire_at rather than let it hold up firing.
+        await sleep_until(probe_at)
+        started = self.trace.clock()
+        headers = await self._headers()
+        try:
+            probe = self._send(self.with_suffix(southwest.CHECKIN_PATH), headers, deadline=fire_at)
+            r, data = await asyncio.wait_for(probe, max(0, fire_at - monotonic()))
+            page = json_page(data)
+        except (ValueError, DeadlineExceeded, asyncio.TimeoutError):
+            page = None
+        self.trace.record('prepare_checkin', started)
+        if page and 'checkIn' in (page.get('_links') or {}):
+            self.checkin_link = page['_links']['checkIn']
+            return self.checkin_link
+        print("Check-in link not available yet, will fetch it when firing")
+        return None
+
+    async def try_checkin(self, link=None):
+        # A single attempt with no retries; returns the confirmation or None.
+        # Without a prepared link the check-in page is fetched first.
+        headers = await self._headers()
+        try:
+            if link is None:
+                r, data = await self._send(self.with_suffix(southwest.CHECKIN_PATH), headers, bucket=rate_limit.checkin)
+                page = json_page(data)
+                if not page or 'checkIn' not in (page.get('_links') or {}):
+                    return None
+                link = page['_links']['checkIn']
+            started = self.trace.clock()
+            r, data = await self._send(self.checkin_url(link), headers, link['body'], rate_limit.checkin)
+            self.trace.record('checkin_post', started)
+            confirmation = json_page(data)
+        except ValueError:
+            return None
+        if confirmation and 'flights' in confirmation:
+            return confirmation
+        return None
 
-    def checkin(self):
-        data = self.get_checkin_data()
+    async def fire_checkin(self):
+        link = self.checkin_link
+        if link is None:
+            return await self.checkin()
+        self.checkin_link = None
+        print("Attempting check-in with prepared link...")
+        confirmation = await self.try_checkin(link)
+        if confirmation:
+            return confirmation
+        print("Prepared check-in link was rejected, falling back to a full check-in")
+        return await self.checkin()
+
+    async def checkin(self):
+        # Only ever called once the window is due
+        data = await self.get_checkin_data(rate_limit.checkin)
         info_needed = data['_links']['checkIn']
-        url = "{}mobile-air-operations{}".format(BASE_URL, info_needed['href'])
         print("Attempting check-in...")
-        confirmation = self.load_json_page(url, info_needed['body'])
+        started = self.trace.clock()
+        confirmation = await self.load_json_page(self.checkin_url(info_needed), info_needed['body'], rate_limit.checkin)
+        self.trace.record('checkin_post', started)
         return confirmation
 
 
-def timezone_for_airport(airport_code):
-    tzrequest = {'iata': airport_code,
-                 'country': 'ALL',
-                 'db': 'airports',
-                 'iatafilter': 'true',
-                 'action': 'SEARCH',
-                 'offset': '0'}
-    tzresult = requests.post("https://openflights.org/php/apsearch.php", tzrequest)
-    airport_tz = pytz.timezone(json.loads(tzresult.text)['airports'][0]['tz_id'])
-    return airport_tz
+async def sleep_until(target):
+    # Coarse sleep, then spin for the last SPIN_SECONDS since event loop
+    # timers routinely overshoot by a few milliseconds
+    remaining = target - monotonic()
+    if remaining > SPIN_SECONDS:
+        await asyncio.sleep(remaining - SPIN_SECONDS)
+    while monotonic() < target:
+        # Yield so other reservations on the loop keep running
+        await asyncio.sleep(0)
+
+
+def hedge_offsets(attempts=None, stagger=None):
+    # Offsets in seconds, centred on the fire time
+    attempts = HEDGE_ATTEMPTS if attempts is None else attempts
+    stagger = HEDGE_STAGGER_SECONDS if stagger is None else stagger
+    return [round((i - (attempts - 1) / 2.0) * stagger, 3) for i in range(attempts)]
+
 
-def schedule_checkin(flight_time, reservation):
+def hedge_bias():
+    return _hedge_stats['bias']
+
+
+def record_hedge_win(offset):
+    wins = _hedge_stats['wins']
+    wins[offset] = wins.get(offset, 0) + 1
+    # Nudge the centre of future attempts toward the offset that won
+    bias = _hedge_stats['bias'] + HEDGE_LEARNING_RATE * offset
+    _hedge_stats['bias'] = max(-HEDGE_MAX_BIAS_SECONDS, min(HEDGE_MAX_BIAS_SECONDS, bias))
+
+
+async def hedged_checkin(reservation, fire_at, offsets):
+    link = reservation.checkin_link
+    reservation.checkin_link = None
+
+    async def attempt(offset):
+        await sleep_until(fire_at + offset)
+        return offset, await reservation.try_checkin(link)
+
+    print("Attempting hedged check-in at offsets {}".format(offsets))
+    pending = set(asyncio.ensure_future(attempt(offset)) for offset in offsets)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    print("Hedged attempt failed: {}".format(task.exception()))
+                    continue
+                offset, confirmation = task.result()
+                if confirmation:
+                    record_hedge_win(offset)
+                    print("Hedged attempt at {:+.3f}s won, wins so far {}".format(offset, _hedge_stats['wins']))
+                    return confirmation
+    finally:
+        # First success wins; the rest are no longer needed
+        for task in pending:
+            task.cancel()
+    print("No hedged attempt succeeded, falling back to a full check-in")
+    return await reservation.checkin()
+
+
+async def schedule_checkin(flight_time, reservation):
+    # One trace record per check-in, whichever way it ends
+    trace = reservation.trace
+    try:
+        data = await _schedule_checkin(flight_time, reservation)
+    except BaseException as e:
+        trace.emit(departure=flight_time.isoformat(), outcome=type(e).__name__)
+        raise
+    if isinstance(data, dict):
+        trace.emit(departure=flight_time.isoformat(), outcome='checked_in', boarding=[
+            "{}{}".format(doc['boardingGroup'], doc['boardingPosition']) for flight in data['flights'] for doc in flight['passengers']])
+    else:
+        trace.emit(departure=flight_time.isoformat(), outcome='not_scheduled')
+    return data
+
+
+async def _schedule_checkin(flight_time, reservation):
+    trace = reservation.trace
+    fire_at = None
+    offsets = [0.0]
     # Move back one day for the checkin time
     checkin_time = flight_time - timedelta(days=1)
-    current_time = datetime.utcnow().replace(tzinfo=pytz.utc)
+    # Compare against Southwest's clock rather than ours
+    started = trace.clock()
+    await server_clock.calibrate_async(reservation.session)
+    trace.record('calibrate', started)
+    current_time = server_clock.server_utcnow().replace(tzinfo=pytz.utc)
     # check to see if we need to sleep until 24 hours before flight
     if checkin_time > current_time:
-        # calculate duration to sleep
-        delta = (checkin_time - current_time).total_seconds() - CHECKIN_EARLY_SECONDS
+        # calculate duration to sleep, leaving early by the one-way trip time
+        # but no earlier than the clock estimate allows
+        delta = (checkin_time - current_time).total_seconds() - server_clock.lead_seconds(CHECKIN_EARLY_SECONDS)
         if delta > 300:
             print("Too early to check in.  Please reschedule 5 minutes before. {} seconds too early.".format(trunc(delta)))
             return "Too early to schedule function."
@@ -146,52 +353,199 @@ def schedule_checkin(flight_time, reservation):
             m, s = divmod(delta, 60)
             h, m = divmod(m, 60)
             print("Too early to check in.  Waiting {} hours, {} minutes, {} seconds".format(trunc(h), trunc(m), s))
-            try:
-                sleep(delta)
-            except OverflowError:
-                print("System unable to sleep for that long, try checking in closer to your departure date")
-                sys.exit(1)
-    data = reservation.checkin()
+            # Pin the target to the monotonic clock so wall clock steps can't move it
+            fire_at = monotonic() + delta
+            offsets = hedge_offsets()
+            if len(offsets) > 1:
+                fire_at += hedge_bias()
+            if delta > PREWARM_SECONDS:
+                await sleep_until(fire_at - PREWARM_SECONDS)
+                await reservation.prewarm()
+                await reservation.prepare_checkin(fire_at + min(offsets) - SPIN_SECONDS, fire_at + min(offsets))
+    if fire_at is not None and len(offsets) > 1:
+        reservation.sent_at = None
+        data = await hedged_checkin(reservation, fire_at, offsets)
+    else:
+        if fire_at is not None:
+            await sleep_until(fire_at)
+            # How late the wake-up was, before any request goes out
+            trace.note(wake_late_ms=round((monotonic() - fire_at) * 1000, 3))
+        reservation.sent_at = None
+        data = await reservation.fire_checkin()
+    if fire_at is not None:
+        print("Check-in request left {:+.1f} ms from target".format((reservation.sent_at - fire_at) * 1000))
+        trace.note(fire_offset_ms=round((reservation.sent_at - fire_at) * 1000, 3))
     for flight in data['flights']:
         for doc in flight['passengers']:
             print("{} got {}{}!".format(doc['name'], doc['boardingGroup'], doc['boardingPosition']))
+    return data
+
+
+async def checkin_reservation(reservation_number, first_name, last_name, verbose=False, session=None, deadline=None):
+    r = Reservation(reservation_number, first_name, last_name, verbose, session, deadline)
+    try:
+        body = await r.lookup_existing_reservation()
+        started = r.trace.clock()
+        # Off the event loop, since an airport missing from the bundled index is
+        # looked up with a blocking request
+        departures = await asyncio.get_running_loop().run_in_executor(None, southwest.upcoming_legs, body)
+        r.trace.record('departures', started)
+    except BaseException as e:
+        # schedule_checkin emits the record for every leg it gets to; this
+        # is the one for a check-in that never got that far
+        r.trace.emit(outcome=type(e).__name__)
+        raise
+
+    # Legs of a trip are checked in concurrently on the same event loop
+    legs = []
+
+    for index, (_, date, _, airport) in enumerate(departures):
+        # found a flight for checkin!
+        print("Flight information found, departing {} at {}".format(airport, date.strftime('%b %d %I:%M%p')))
+        # Every leg gets its own Reservation, so traces, timings and prepared
+        # links aren't mixed between legs; the first keeps the lookup's phases
+        leg = r if index == 0 else Reservation(reservation_number, first_name, last_name, verbose, session, deadline)
+        legs.append(schedule_checkin(date, leg))
+
+    return await asyncio.gather(*legs)
+
+
+def snapshot_departure(job):
+    # Departure resolved when the flight was stored, if the message carries
+    # one, in the zone stored alongside it so nothing is looked up again
+    if not job.get('departure_time'):
+        return None
+    departure = datetime.fromisoformat(job['departure_time'])
+    if job.get('airport_tz'):
+        return departure.astimezone(pytz.timezone(job['airport_tz']))
+    return departure.astimezone(timezone_for_airport(job['airport_code']))
+
+
+async def checkin_leg(job, date, session=None, deadline=None):
+    # Go straight to the one leg that is due; no reservation or timezone lookup
+    r = Reservation(job['reservation_number'], job['first_name'], job['last_name'], job.get('verbose', False), session, deadline)
+    print("Flight information found, leg {} departing {} at {}".format(job.get('leg_index'), job['airport_code'], date.strftime('%b %d %I:%M%p')))
+    return [await schedule_checkin(date, r)]
+
+
+def run_job(job, session=None, deadline=None, departure=None):
+    # Messages from find_flights carry a departure snapshot; older ones
+    # (and manual runs) fall back to looking the reservation up. Callers
+    # that already resolved the snapshot pass it as departure.
+    if departure is None:
+        departure = snapshot_departure(job)
+    if departure is not None:
+        return checkin_leg(job, departure, session, deadline)
+    return checkin_reservation(job['reservation_number'], job['first_name'], job['last_name'], job.get('verbose', False), session, deadline)
+
+
+def group_key(job):
+    # One check-in covers every passenger on a PNR, so jobs for the same
+    # confirmation number firing at the same instant are the same work
+    return (job['reservation_number'].upper(), job.get('departure_time'))
+
+
+def passengers(job):
+    return job.get('passengers') or [{'first_name': job['first_name'], 'last_name': job['last_name']}]
+
+
+def merge_jobs(job, other):
+    # Fold other's passengers into job, which is the one that gets run
+    known = set((p['first_name'].lower(), p['last_name'].lower()) for p in passengers(job))
+    merged = list(passengers(job))
+    for p in passengers(other):
+        if (p['first_name'].lower(), p['last_name'].lower()) not in known:
+            merged.append(p)
+            known.add((p['first_name'].lower(), p['last_name'].lower()))
+    job['passengers'] = merged
+    return job
+
+
+def group_jobs(jobs):
+    """ Merge jobs that share a group_key.
+    Returns:
+        list: (job to run, indexes of the original jobs it covers) pairs.
+    """
+    groups = OrderedDict()
+    for index, job in enumerate(jobs):
+        key = group_key(job)
+        if key in groups:
+            merge_jobs(groups[key][0], job)
+            groups[key][1].append(index)
+        else:
+            groups[key] = (dict(job), [index])
+    return list(groups.values())
+
+
+def report_passengers(job, results):
+    # Fan a shared confirmation back out to each passenger that asked for it
+    boarding = {}
+    for data in results or []:
+        if isinstance(data, dict):
+            for flight in data.get('flights', []):
+                for doc in flight['passengers']:
+                    boarding[doc['name'].lower()] = "{}{}".format(doc['boardingGroup'], doc['boardingPosition'])
+    for p in passengers(job):
+        position = None
+        for name, value in boarding.items():
+            if p['first_name'].lower() in name and p['last_name'].lower() in name:
+                position = value
+        if position is None:
+            print("{} {} ({}) has no boarding position".format(p['first_name'], p['last_name'], job['reservation_number']))
+        else:
+            print("{} {} ({}) checked in with {}".format(p['first_name'], p['last_name'], job['reservation_number'], position))
+
+
+def checked_in(results):
+    # True if at least one leg came back with a boarding position
+    return any(isinstance(data, dict) and 'flights' in data for data in results or [])
+
+
+async def _run_job(job, session, deadline):
+    try:
+        # Requests give up cleanly at the deadline; wait_for is the backstop
+        results = await asyncio.wait_for(run_job(job, session, monotonic() + deadline), deadline)
+        report_passengers(job, results)
+        return results
+    except asyncio.TimeoutError:
+        print("Deadline of {} seconds passed for {}, cancelled check-in".format(deadline, job['reservation_number']))
+        raise
+
+
+async def run_checkins(jobs, deadline=CHECKIN_DEADLINE_SECONDS):
+    """ Check in many reservations concurrently on the running event loop.
+    Args:
+        jobs (list): Dicts with reservation_number, first_name and last_name,
+            plus the departure snapshot fields when find_flights sent them.
+        deadline (float): Seconds each reservation may take before it is cancelled.
+    Returns:
+        list: Per-job result, or the exception that job raised.
+    """
+    groups = group_jobs(jobs)
+    if len(groups) < len(jobs):
+        print("Merged {} check-in jobs into {}".format(len(jobs), len(groups)))
+    async with http_sessions.async_session() as session:
+        tasks = [asyncio.ensure_future(_run_job(job, session, deadline)) for job, _ in groups]
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Cancel whatever is still running if we are interrupted
+            for task in tasks:
+                task.cancel()
+    # Every original job gets the result of the check-in that covered it
+    fanned_out = [None] * len(jobs)
+    for (_, indexes), result in zip(groups, results):
+        for index in indexes:
+            fanned_out[index] = result
+    return fanned_out
 
 
 def auto_checkin(reservation_number, first_name, last_name, verbose=False):
-    r = Reservation(reservation_number, first_name, last_name, verbose)
-    body = r.lookup_existing_reservation()
-
-    # Get our local current time
-    now = datetime.utcnow().replace(tzinfo=pytz.utc)
-
-    # Kick off threads for handling legs of a trip asynchronously
-    threads = []
-
-    # find all eligible legs for checkin
-    for leg in body['bounds']:
-        # calculate departure for this leg
-        airport = "{}, {}".format(leg['departureAirport']['name'], leg['departureAirport']['state'])
-        takeoff = "{} {}".format(leg['departureDate'], leg['departureTime'])
-        airport_tz = timezone_for_airport(leg['departureAirport']['code'])
-        date = airport_tz.localize(datetime.strptime(takeoff, '%Y-%m-%d %H:%M'))
-        if date > now:
-            # found a flight for checkin!
-            print("Flight information found, departing {} at {}".format(airport, date.strftime('%b %d %I:%M%p')))
-            # Checkin with a thread
-            t = Thread(target=schedule_checkin, args=(date, r))
-            t.daemon = True
-            t.start()
-            threads.append(t)
-
-    # cleanup threads while handling Ctrl+C
-    while True:
-        if len(threads) == 0:
-            break
-        for t in threads:
-            t.join(5)
-            if not t.isAlive():
-                threads.remove(t)
-                break
+    job = {'reservation_number': reservation_number, 'first_name': first_name, 'last_name': last_name, 'verbose': verbose}
+    result = asyncio.run(run_checkins([job]))[0]
+    if isinstance(result, BaseException):
+        raise result
+    return result
 
 def base64decoder(encoded_data):
     decoded_string = base64.b64decode(encoded_data)
@@ -229,10 +583,12 @@ def checkin_flight(event, context):
             first_name = event['first_name']
             last_name = event['last_name']
             print("{} {} - {}".format(first_name, last_name, reservation_number))
-            verbose = False
+            event['verbose'] = False
         
         try:
-            auto_checkin(reservation_number, first_name, last_name, verbose)
+            result = asyncio.run(run_checkins([event]))[0]
+            if isinstance(result, BaseException):
+                raise result
         except KeyboardInterrupt:
             print("Ctrl+C detected, canceling checkin")
             sys.exit()
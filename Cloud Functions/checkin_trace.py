@@ -0,0 +1,80 @@
+import json
+import os
+from collections import Counter
+from time import perf_counter
+
+# Set CHECKIN_TRACE=true to log one JSON record per check-in; when off every
+# hook is a no-op method on a shared object
+ENABLED = os.environ.get('CHECKIN_TRACE', 'false').lower() == 'true'
+
+
+class Trace():
+    """ Phase timings and attempt counts for one reservation's check-in.
+    Callers take clock() before a phase and record() it afterwards; emit()
+    prints everything as a single JSON line, which Cloud Logging indexes
+    as a structured entry.
+    """
+
+    def __init__(self, reservation):
+        self.reservation = reservation
+        self.phases = {}
+        self.attempts = Counter()
+        self.fields = {}
+
+    @staticmethod
+    def clock():
+        return perf_counter()
+
+    def record(self, phase, started):
+        elapsed = (perf_counter() - started) * 1000
+        stats = self.phases.get(phase)
+        if stats is None:
+            self.phases[phase] = {'count': 1, 'total_ms': elapsed, 'max_ms': elapsed}
+        else:
+            stats['count'] += 1
+            stats['total_ms'] += elapsed
+            stats['max_ms'] = max(stats['max_ms'], elapsed)
+
+    def attempt(self, status):
+        self.attempts[str(status)] += 1
+
+    def note(self, **fields):
+        self.fields.update(fields)
+
+    def emit(self, **fields):
+        record = {'event': 'checkin_trace', 'reservation': self.reservation}
+        record.update(self.fields)
+        record.update(fields)
+        record['phases'] = dict((phase, {
+            'count': stats['count'],
+            'total_ms': round(stats['total_ms'], 3),
+            'max_ms': round(stats['max_ms'], 3),
+        }) for phase, stats in self.phases.items())
+        record['attempts'] = dict(self.attempts)
+        print(json.dumps(record, default=str))
+
+
+class _NullTrace():
+
+    @staticmethod
+    def clock():
+        return 0.0
+
+    def record(self, phase, started):
+        pass
+
+    def attempt(self, status):
+        pass
+
+    def note(self, **fields):
+        pass
+
+    def emit(self, **fields):
+        pass
+
+
+NULL = _NullTrace()
+
+
+def start(reservation):
+    return Trace(reservation) if ENABLED else NULL
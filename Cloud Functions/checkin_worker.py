@@ -0,0 +1,202 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+aiohttp
+google-cloud-pubsub
+pytz
+requests
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import os
+from datetime import timedelta
+from time import monotonic
+import pytz
+from google.cloud import pubsub_v1
+import checkin_flight
+import http_sessions
+import server_clock
+import southwest
+from southwest_errors import RetriesExhausted
+
+# To Do
+PROJECT_ID = os.environ.get('GCP_PROJECT', "GCPPROJECT")
+SUBSCRIPTION_ID = os.environ.get('CHECKIN_SUBSCRIPTION', "YOURSUBSCRIPTION")
+# Flow control: how many check-ins the worker holds at once
+WORKER_MAX_MESSAGES = int(os.environ.get('WORKER_MAX_MESSAGES', 500))
+# Messages are leased until their check-in is confirmed, which can be up to a day away
+WORKER_MAX_LEASE_SECONDS = int(os.environ.get('WORKER_MAX_LEASE_SECONDS', 25 * 60 * 60))
+# Hand a job to the check-in handler this long before its window opens,
+# comfortably inside schedule_checkin's five minute limit
+WORKER_LEAD_SECONDS = float(os.environ.get('WORKER_LEAD_SECONDS', 120))
+
+
+class CheckinWorker():
+    """ Pulls check-in jobs from Pub/Sub and runs them on one event loop.
+    Jobs wait in a timer heap until shortly before their window opens, and
+    every job shares the same aiohttp session, header cache and clock
+    calibration. A message is acked once its check-in is confirmed, or once
+    retrying can't help: the reservation is dead, its flight has left, or
+    the attempt failed after the window opened. Only failures before the
+    window are nacked for redelivery.
+    """
+
+    def __init__(self, subscription_path, max_messages=WORKER_MAX_MESSAGES):
+        self.subscription_path = subscription_path
+        self.max_messages = max_messages
+        # (monotonic time to start, sequence, job, messages, departure snapshot, window)
+        self.heap = []
+        # group_key -> (job, messages) still waiting in the heap
+        self.waiting = {}
+        self.sequence = itertools.count()
+        self.running = set()
+        self.loop = None
+        self.wakeup = None
+        self.session = None
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        async with http_sessions.async_session() as session:
+            self.session = session
+            subscriber = pubsub_v1.SubscriberClient()
+            flow_control = pubsub_v1.types.FlowControl(max_messages=self.max_messages, max_lease_duration=WORKER_MAX_LEASE_SECONDS)
+            streaming_pull = subscriber.subscribe(self.subscription_path, callback=self._on_message, flow_control=flow_control)
+            print("Listening for check-ins on {}".format(self.subscription_path))
+            try:
+                await self._dispatch()
+            finally:
+                streaming_pull.cancel()
+                subscriber.close()
+                for task in self.running:
+                    task.cancel()
+
+    def _on_message(self, message):
+        # Called on the subscriber's threads; everything else happens on the loop
+        asyncio.run_coroutine_threadsafe(self.enqueue(message), self.loop)
+
+    async def enqueue(self, message):
+        try:
+            job = json.loads(message.data.decode('utf-8'))
+            if job['reservation_number'] == 'Priming':
+                message.ack()
+                return
+            key = checkin_flight.group_key(job)
+            if key in self.waiting:
+                # Ride along with the check-in already queued for this PNR
+                waiting_job, messages = self.waiting[key]
+                checkin_flight.merge_jobs(waiting_job, job)
+                messages.append(message)
+                return
+            # Airports missing from the bundled index are looked up with a
+            # blocking request, which mustn't stall every timer on the loop
+            departure = await self.loop.run_in_executor(None, checkin_flight.snapshot_departure, job)
+            planned = await self.plan(job, departure)
+        except RetriesExhausted as e:
+            # Southwest kept refusing the lookup; redelivering would only repeat it
+            print("Giving up on {!r}: {}".format(message.data, e))
+            message.ack()
+            return
+        except Exception as e:
+            print("Unable to plan check-in for {!r}: {!r}".format(message.data, e))
+            message.nack()
+            return
+        if planned is None:
+            print("No upcoming flights for {}".format(job['reservation_number']))
+            message.ack()
+            return
+        start_at, window = planned
+        if key in self.waiting:
+            # Another message for this group was planned while we were
+            checkin_flight.merge_jobs(self.waiting[key][0], job)
+            self.waiting[key][1].append(message)
+            return
+        messages = [message]
+        self.waiting[key] = (job, messages)
+        heapq.heappush(self.heap, (start_at, next(self.sequence), job, messages, departure, window))
+        self.wakeup.set()
+
+    async def plan(self, job, departure=None):
+        """ Work out when to hand the job over.
+        Returns:
+            tuple: (monotonic time to start, UTC time the window opens), or
+                None if nothing is left to check in.
+        """
+        if departure is not None:
+            departures = [(departure, job['airport_code'])]
+        else:
+            r = checkin_flight.Reservation(job['reservation_number'], job['first_name'], job['last_name'], job.get('verbose', False), self.session)
+            body = await r.lookup_existing_reservation()
+            legs = await self.loop.run_in_executor(None, southwest.upcoming_legs, body)
+            departures = [(date, airport_code) for _, date, airport_code, _ in legs]
+        await server_clock.calibrate_async(self.session)
+        now = server_clock.server_utcnow().replace(tzinfo=pytz.utc)
+        # A redelivered message can outlive its flight
+        departures = [(date, airport) for date, airport in departures if date > now]
+        if not departures:
+            return None
+        checkin_time = min(date for date, _ in departures) - timedelta(days=1)
+        delay = (checkin_time - now).total_seconds() - WORKER_LEAD_SECONDS
+        print("{} queued, window opens in {:.0f} seconds".format(job['reservation_number'], delay + WORKER_LEAD_SECONDS))
+        return monotonic() + max(delay, 0), checkin_time
+
+    async def _dispatch(self):
+        while True:
+            self.wakeup.clear()
+            while self.heap and self.heap[0][0] <= monotonic():
+                _, _, job, messages, departure, window = heapq.heappop(self.heap)
+                self.waiting.pop(checkin_flight.group_key(job), None)
+                task = asyncio.ensure_future(self.handle(job, messages, departure, window))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+            timeout = self.heap[0][0] - monotonic() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def handle(self, job, messages, departure=None, window=None):
+        # The same handler the checkin_flight Cloud Function runs
+        try:
+            deadline = checkin_flight.CHECKIN_DEADLINE_SECONDS
+            results = await asyncio.wait_for(checkin_flight.run_job(job, self.session, monotonic() + deadline, departure), deadline)
+        except Exception as e:
+            print("Check-in failed for {}: {!r}".format(job['reservation_number'], e))
+            self.release(job, messages, window, permanent=isinstance(e, RetriesExhausted))
+            return
+        checkin_flight.report_passengers(job, results)
+        if checkin_flight.checked_in(results):
+            for message in messages:
+                message.ack()
+        else:
+            print("Check-in not confirmed for {}".format(job['reservation_number']))
+            self.release(job, messages, window)
+
+    def release(self, job, messages, window, permanent=False):
+        # Without a dead-letter policy a nacked message comes straight back
+        # and fires again, so only nack while a retry can still make the window
+        now = server_clock.server_utcnow().replace(tzinfo=pytz.utc)
+        if permanent or (window is not None and now >= window):
+            print("Giving up on {}, acking {} messages".format(job['reservation_number'], len(messages)))
+            for message in messages:
+                message.ack()
+        else:
+            print("Releasing {} messages for {}".format(len(messages), job['reservation_number']))
+            for message in messages:
+                message.nack()
+
+
+def main():
+    subscription_path = pubsub_v1.SubscriberClient.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
+    try:
+        asyncio.run(CheckinWorker(subscription_path).run())
+    except KeyboardInterrupt:
+        print("Ctrl+C detected, unacked check-ins will be redelivered")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+firebase_admin
+pytz
+"""
+
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+from threading import Lock
+from time import monotonic
+import pytz
+
+# Markers live in their own collection; give it a Firestore TTL policy on
+# expires_at to have old markers cleaned up automatically
+MARKER_COLLECTION = u'EmailDedupe'
+DEDUPE_TTL_SECONDS = float(os.environ.get('DEDUPE_TTL_SECONDS', 3 * 24 * 60 * 60))
+DEDUPE_CACHE_SIZE = int(os.environ.get('DEDUPE_CACHE_SIZE', 10000))
+
+_FORWARD_PREFIX = re.compile(r"^\s*((fwd?|fw|re)\s*:\s*)+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+class ExpiringCache():
+    """ Bounded LRU set whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < monotonic():
+                del self.entries[key]
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def add(self, key):
+        with self.lock:
+            self.entries[key] = monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+_recent = ExpiringCache(DEDUPE_CACHE_SIZE, DEDUPE_TTL_SECONDS)
+
+
+def content_key(subject, body):
+    # Same email delivered again, or forwarded without edits
+    subject = _FORWARD_PREFIX.sub('', subject or '')
+    normalized = _WHITESPACE.sub(' ', subject + "\n" + (body or '')).strip()
+    return 'content:' + hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def reservation_key(reservation, fname, lname):
+    # Any copy of the itinerary for this passenger on this PNR
+    return 'pnr:{}:{}:{}'.format(reservation.upper(), fname.lower(), lname.lower())
+
+
+def _marker_id(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def seen(key):
+    # In-memory only; cheap enough to run before parsing
+    return key in _recent
+
+
+def claim(db, key):
+    """ Record key, returning False if it was already claimed.
+    Checks the in-memory cache first, then atomically creates a Firestore
+    marker so copies landing on other instances are caught as well.
+    """
+    if key in _recent:
+        return False
+    from google.api_core.exceptions import AlreadyExists
+    now = datetime.utcnow().replace(tzinfo=pytz.utc)
+    marker = {u'key': key, u'expires_at': now + timedelta(seconds=DEDUPE_TTL_SECONDS)}
+    doc_ref = db.collection(MARKER_COLLECTION).document(_marker_id(key))
+    try:
+        doc_ref.create(marker)
+    except AlreadyExists:
+        existing = doc_ref.get().to_dict() or {}
+        expires_at = existing.get(u'expires_at')
+        if expires_at is None or expires_at > now:
+            _recent.add(key)
+            return False
+        # Expired but not cleaned up yet
+        doc_ref.set(marker)
+    _recent.add(key)
+    return True
+
+
+def claim_many(db, keys):
+    """ Bulk claim() for backfills: one read for every marker instead of a
+    create per key. The markers come back as writes for the caller to commit
+    alongside its own, so unlike claim() it doesn't guard against another
+    writer claiming the same key at the same moment.
+    Returns:
+        tuple: (keys nobody had claimed, [(DocumentReference, dict)] marker writes).
+    """
+    now = datetime.utcnow().replace(tzinfo=pytz.utc)
+    refs = OrderedDict()
+    for key in keys:
+        if key not in _recent and key not in refs:
+            refs[key] = db.collection(MARKER_COLLECTION).document(_marker_id(key))
+    claimed = set()
+    for snapshot in db.get_all(list(refs.values())):
+        existing = snapshot.to_dict() if snapshot.exists else None
+        if existing is not None and (existing.get(u'expires_at') is None or existing[u'expires_at'] > now):
+            claimed.add(snapshot.id)
+    unclaimed, writes = [], []
+    marker_expires = now + timedelta(seconds=DEDUPE_TTL_SECONDS)
+    for key, doc_ref in refs.items():
+        _recent.add(key)
+        if doc_ref.id not in claimed:
+            unclaimed.append(key)
+            writes.append((doc_ref, {u'key': key, u'expires_at': marker_expires}))
+    return unclaimed, writes
+
+
+def release(db, key):
+    # Undo a claim whose write failed, so a retry isn't treated as a duplicate
+    _recent.discard(key)
+    db.collection(MARKER_COLLECTION).document(_marker_id(key)).delete()
+
+
+def remember(key):
+    _recent.add(key)
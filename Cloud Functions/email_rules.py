@@ -0,0 +1,124 @@
+import os
+import re
+from collections import Counter
+from collections import namedtuple
+
+# What a confirmation email told us; any field may be None if parsing fell short
+Parsed = namedtuple('Parsed', ['rule', 'fname', 'lname', 'reservation'])
+
+# Per-rule hit counts for this process
+hits = Counter()
+
+# Every field we extract sits near the top of the body, so only this many
+# characters are ever searched
+EMAIL_BODY_CAP = int(os.environ.get('EMAIL_BODY_CAP', 16 * 1024))
+
+
+class Rule():
+    """ One supported email format.
+    A rule claims an email when its subject test passes (a substring check
+    when needle is set, otherwise the precompiled subject pattern) and then
+    extracts the fields, so classification stops at the first claim.
+    """
+
+    def __init__(self, name, description, extract, pattern=None, needle=None):
+        self.name = name
+        self.description = description
+        self.extract = extract
+        self.pattern = re.compile(pattern) if pattern else None
+        self.needle = needle
+
+    def match(self, subject):
+        if self.needle is not None:
+            return self.needle in subject
+        return self.pattern.search(subject)
+
+
+# Try to match `(5OK3YZ) | 22APR20 | DIA-OAK | Obama/Barack`
+def _legacy(match, subject, body):
+    lname, fname = match.group(2).split('/')
+    return fname, lname, match.group(1)
+
+
+_ITINERARY_RESERVATION = re.compile(r"\(([A-Z0-9]{6})\)")
+_ITINERARY_PASSENGER = re.compile(r"PASSENGER([\w\s]+)Check in")
+
+def _itinerary(match, subject, body):
+    fname, lname, reservation = None, None, None
+    found = _ITINERARY_RESERVATION.search(subject)
+    if found:
+        reservation = found.group(1)
+    found = _ITINERARY_PASSENGER.search(body)
+    if found:
+        name_parts = found.group(1).strip().split(' ')
+        fname, lname = name_parts[0], name_parts[-1]
+    return fname, lname, reservation
+
+
+#
+# AIR Confirmation: ABC123
+# *Passenger(s)*
+# BARACK/OBAMA W
+#
+_TICKETLESS_BODY = re.compile(r"AIR Confirmation:\s+([A-Z0-9]{6})\s+\*Passenger\(s\)\*\s+(\w+\/\w+)")
+
+def _ticketless(match, subject, body):
+    found = _TICKETLESS_BODY.search(body)
+    if not found:
+        return None, None, None
+    lname, fname = found.group(2).strip().split('/')
+    return fname, lname, found.group(1)
+
+
+# This matches a variety of new email formats which look like
+# Barack Obamas's 12/25 Oakland trip (ABC123)
+def _new(match, subject, body):
+    return match.group(1), match.group(2), match.group(3)
+
+
+# ABC123 Barack Obama
+def _manual(match, subject, body):
+    return match.group(2), match.group(3), match.group(1)
+
+
+# Ordered: the first rule whose subject test passes owns the email
+RULES = (
+    Rule('legacy', "Found a legacy reservation email", _legacy, pattern=r"\(([A-Z0-9]{6})\).*\| (\w+ ?\w+\/\w+)"),
+    Rule('itinerary', "Found an itinerary email", _itinerary, needle="Here's your itinerary!"),
+    Rule('ticketless', "Found ticketless itinerary email", _ticketless, needle="Passenger Itinerary"),
+    Rule('new', "Found new email subject match", _new, pattern=r"(?:[Ff][Ww][Dd]?: )?(\w+).* (\w+)'s.*\(([A-Z0-9]{6})\)"),
+    Rule('manual', "Found manual email subject match", _manual, pattern=r"([A-Z0-9]{6})\s+(\w+) (\w+ ?\w+)"),
+)
+RULES_BY_NAME = dict((rule.name, rule) for rule in RULES)
+
+
+def reservation_record(fname, lname, reservation):
+    # Document id and fields for the Reservations collection
+    return fname + " " + lname + " - " + reservation, {
+        u'first_name': fname,
+        u'last_name': lname,
+        u'reservation_number': reservation
+    }
+
+
+def cap_body(body, cap=None):
+    return (body or '')[:EMAIL_BODY_CAP if cap is None else cap]
+
+
+def classify(subject, body=''):
+    """ Parse a confirmation email in a single pass over RULES.
+    Returns:
+        Parsed: rule is None when no format matched.
+    """
+    for rule in RULES:
+        match = rule.match(subject)
+        if match:
+            hits[rule.name] += 1
+            fname, lname, reservation = rule.extract(match, subject, cap_body(body))
+            # Short circuit we incorrectly match the first name
+            # TODO(dw): Remove this when we fix this case in the parser
+            if fname and fname.lower() in ('fwd', 'fw'):
+                fname = None
+            return Parsed(rule.name, fname, lname, reservation)
+    hits[None] += 1
+    return Parsed(None, None, None, None)
@@ -0,0 +1,97 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+firebase_admin
+google-cloud-pubsub
+"""
+
+from threading import Lock
+from time import perf_counter
+
+# Firestore caps a single WriteBatch at 500 writes
+MAX_BATCH_WRITES = 500
+
+# Clients live for the life of the process, so warm invocations and every
+# thread in them share the same gRPC channels
+_clients = {}
+_timings = {}
+_lock = Lock()
+
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is not None:
+        _timings[name]['reused'] += 1
+        return client
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            started = perf_counter()
+            client = factory()
+            _timings[name] = {'created_ms': (perf_counter() - started) * 1000, 'reused': 0}
+            _clients[name] = client
+        else:
+            _timings[name]['reused'] += 1
+    return client
+
+
+def _firestore_factory():
+    import firebase_admin
+    from firebase_admin import firestore
+    # Use the application default credentials
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app()
+    return firestore.client()
+
+
+def firestore_client():
+    return _get_or_create('firestore', _firestore_factory)
+
+
+def publisher_client(batch_settings=None):
+    """ Return the shared Pub/Sub publisher.
+    Args:
+        batch_settings (google.cloud.pubsub_v1.types.BatchSettings): Only
+            applied when the client is first created.
+    """
+    def factory():
+        from google.cloud import pubsub_v1
+        if batch_settings is None:
+            return pubsub_v1.PublisherClient()
+        return pubsub_v1.PublisherClient(batch_settings)
+    return _get_or_create('publisher', factory)
+
+
+def write_documents(db, writes, deletes=()):
+    """ Set and delete a group of documents in as few round trips as possible.
+    Groups that fit in one WriteBatch are committed atomically; larger
+    imports go through a BulkWriter, which is not atomic.
+    Args:
+        db (google.cloud.firestore.Client): Firestore client.
+        writes (list): (DocumentReference, dict) pairs.
+        deletes (list): DocumentReferences to delete.
+    """
+    writes = list(writes)
+    deletes = list(deletes)
+    if not writes and not deletes:
+        return
+    batched = len(writes) + len(deletes) <= MAX_BATCH_WRITES
+    writer = db.batch() if batched else db.bulk_writer()
+    for doc_ref, data in writes:
+        writer.set(doc_ref, data)
+    for doc_ref in deletes:
+        writer.delete(doc_ref)
+    if batched:
+        writer.commit()
+    else:
+        writer.close()
+
+
+def timing_report():
+    # One line per client: what the cold start paid and how often it was avoided since
+    lines = []
+    for name, timing in sorted(_timings.items()):
+        lines.append("{} client: created in {:.1f} ms on cold start, reused {} times (~{:.1f} ms saved)".format(
+            name, timing['created_ms'], timing['reused'], timing['created_ms'] * timing['reused']))
+    return "\n".join(lines)
@@ -0,0 +1,77 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+aiohttp
+requests
+"""
+
+import os
+from functools import partial
+from threading import Lock
+
+# Bounded connection pools; one pool per host, kept alive between requests
+POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 16))
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get('HTTP_CONNECT_TIMEOUT_SECONDS', 3.05))
+READ_TIMEOUT_SECONDS = float(os.environ.get('HTTP_READ_TIMEOUT_SECONDS', 10))
+# The async check-in engine multiplexes many reservations over one pool
+ASYNC_POOL_LIMIT = int(os.environ.get('HTTP_ASYNC_POOL_LIMIT', 100))
+KEEPALIVE_SECONDS = float(os.environ.get('HTTP_KEEPALIVE_SECONDS', 60))
+
+_sessions = {}
+_lock = Lock()
+
+
+def _request_with_timeout(request, timeout, method, url, **kwargs):
+    # Default timeout for every request made through a registry session
+    kwargs.setdefault('timeout', timeout)
+    return request(method, url, **kwargs)
+
+
+def _build_session(pool_connections, pool_maxsize, timeout):
+    # requests is only imported by the first caller that needs a session,
+    # keeping it off the import path of functions that never do
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.request = partial(_request_with_timeout, session.request, timeout)
+    # Retries are handled by the callers, which know what Southwest's
+    # responses mean; the adapter only pools connections
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0, pool_block=False)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(name='default'):
+    """ Return the process-wide session registered under name, creating it on first use.
+    Args:
+        name (str): Logical pool name, e.g. 'southwest' or 'openflights'.
+    """
+    session = _sessions.get(name)
+    if session is None:
+        with _lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = _build_session(POOL_CONNECTIONS, POOL_MAXSIZE, (CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS))
+                _sessions[name] = session
+    return session
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def async_session():
+    """ Build an aiohttp session with the same pool bounds and timeouts.
+    aiohttp sessions are bound to the event loop that creates them, so the
+    caller owns the session and should use it as an async context manager.
+    """
+    import aiohttp
+    connector = aiohttp.TCPConnector(limit=ASYNC_POOL_LIMIT, limit_per_host=ASYNC_POOL_LIMIT, keepalive_timeout=KEEPALIVE_SECONDS)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT_SECONDS, sock_read=READ_TIMEOUT_SECONDS)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
@@ -0,0 +1,80 @@
+import os
+import random
+from threading import Lock
+from time import monotonic
+from time import sleep
+from southwest_errors import DeadlineExceeded
+
+# Shared budget for everything we send to Southwest from this process
+SW_RATE_LIMIT_PER_SECOND = float(os.environ.get('SW_RATE_LIMIT_PER_SECOND', 20))
+SW_RATE_LIMIT_BURST = float(os.environ.get('SW_RATE_LIMIT_BURST', 40))
+# Check-in requests sent once the window opens draw on a budget of their
+# own, so they never queue behind lookups and probes holding earlier tokens
+SW_CHECKIN_RATE_LIMIT_PER_SECOND = float(os.environ.get('SW_CHECKIN_RATE_LIMIT_PER_SECOND', 100))
+SW_CHECKIN_RATE_LIMIT_BURST = float(os.environ.get('SW_CHECKIN_RATE_LIMIT_BURST', 200))
+# Retry delays start at the caller's interval and double up to this cap
+BACKOFF_MAX_SECONDS = float(os.environ.get('SW_BACKOFF_MAX_SECONDS', 2.0))
+
+
+class TokenBucket():
+    """ Thread-safe token bucket usable from threads and coroutines alike.
+    Tokens are reserved up front, so waiters are served in arrival order
+    instead of racing each other when the bucket refills.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def _reserve(self, deadline=None):
+        # Returns how long the caller must wait for its token
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if deadline is not None and now + wait > deadline:
+                raise DeadlineExceeded("Rate limit wait of {:.2f}s would pass the deadline".format(wait))
+            self.tokens -= 1
+            return wait
+
+    def acquire(self, deadline=None):
+        wait = self._reserve(deadline)
+        if wait > 0:
+            sleep(wait)
+
+    async def acquire_async(self, deadline=None):
+        # Already loaded by whoever is running the loop; importing it here
+        # keeps asyncio off the blocking callers' import path
+        import asyncio
+        wait = self._reserve(deadline)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+southwest = TokenBucket(SW_RATE_LIMIT_PER_SECOND, SW_RATE_LIMIT_BURST)
+checkin = TokenBucket(SW_CHECKIN_RATE_LIMIT_PER_SECOND, SW_CHECKIN_RATE_LIMIT_BURST)
+
+
+def backoff_delay(attempt, base, deadline=None, cap=BACKOFF_MAX_SECONDS, steady=0):
+    """ Jittered exponential delay before retry number attempt.
+    Args:
+        attempt (int): 1 for the first retry.
+        base (float): Delay before the first retry, in seconds.
+        deadline (float): Monotonic time the caller must finish by, if any.
+        steady (int): Retries made every base seconds before backing off.
+    Raises:
+        DeadlineExceeded: If waiting would run past the deadline.
+    """
+    if attempt <= steady:
+        delay = base
+    else:
+        ceiling = min(cap, base * 2 ** (attempt - steady - 1))
+        # Equal jitter: never retry immediately, never all at the same moment
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+    if deadline is not None and monotonic() + delay > deadline:
+        raise DeadlineExceeded("Next retry in {:.2f}s would pass the deadline".format(delay))
+    return delay
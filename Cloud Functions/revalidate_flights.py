@@ -0,0 +1,190 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+firebase_admin
+pytz
+requests
+"""
+
+# Re-check upcoming Flights against Southwest ahead of their check-in burst.
+#
+# Meant for an off-peak Cloud Scheduler job (e.g. hourly). Each run looks up
+# every reservation with a flight checking in between REVALIDATE_MIN_LEAD and
+# REVALIDATE_HORIZON from now, rewrites legs whose departure moved, and flags
+# (or deletes) flights on reservations Southwest no longer knows about, so
+# find_flights never dispatches them. A reservation has to come back dead on
+# REVALIDATE_DEAD_STRIKES separate runs before anything is flagged, and
+# flagged flights keep being checked so they can be restored.
+
+import os
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from time import monotonic
+import gcp_clients
+import rate_limit
+import store_flight_information
+from southwest import Reservation
+from southwest import upcoming_legs
+from southwest_errors import RetriesExhausted
+
+# Leave flights this close to check-in alone; they belong to the dispatcher
+REVALIDATE_MIN_LEAD = timedelta(minutes=float(os.environ.get('REVALIDATE_MIN_LEAD_MINUTES', 30)))
+REVALIDATE_HORIZON = timedelta(hours=float(os.environ.get('REVALIDATE_HORIZON_HOURS', 7 * 24)))
+# Lookups per second, drawn on top of the shared Southwest budget
+REVALIDATE_RATE_PER_SECOND = float(os.environ.get('REVALIDATE_RATE_PER_SECOND', 2))
+# Stop starting new lookups after this long, well inside the function timeout
+REVALIDATE_DEADLINE_SECONDS = float(os.environ.get('REVALIDATE_DEADLINE_SECONDS', 7 * 60))
+# A dead reservation answers NOT_FOUND forever; don't spend MAX_ATTEMPTS on it.
+# One run's verdict is only a strike, so a brief hiccup can't drop a flight.
+REVALIDATE_MAX_ATTEMPTS = int(os.environ.get('REVALIDATE_MAX_ATTEMPTS', 2))
+REVALIDATE_DEAD_STRIKES = int(os.environ.get('REVALIDATE_DEAD_STRIKES', 2))
+# "flag" keeps the documents with cancelled set, "delete" removes them
+REVALIDATE_DEAD_ACTION = os.environ.get('REVALIDATE_DEAD_ACTION', 'flag')
+REVALIDATE_PAGE_SIZE = int(os.environ.get('REVALIDATE_PAGE_SIZE', 200))
+# Southwest's answers for a reservation that was cancelled or never existed
+DEAD_STATUSES = ('NOT_FOUND', 'BAD_REQUEST')
+
+_lookups = rate_limit.TokenBucket(REVALIDATE_RATE_PER_SECOND, 1)
+
+
+def upcoming_reservations(db, start, end):
+    """ Group the undispatched Flights checking in between start and end,
+    including those flagged cancelled, which may have come back.
+    Returns:
+        OrderedDict: upper-cased reservation number -> flight snapshots, soonest first.
+    """
+    query = db.collection(u'Flights').where(u'checkin_time', u'>=', start).where(u'checkin_time', u'<=', end).order_by(u'checkin_time').limit(REVALIDATE_PAGE_SIZE)
+    reservations = OrderedDict()
+    last = None
+    while True:
+        page = query if last is None else query.start_after(last)
+        snapshots = list(page.stream())
+        for snapshot in snapshots:
+            data = snapshot.to_dict() or {}
+            if data.get(u'dispatched'):
+                continue
+            reservations.setdefault(data[u'reservation_number'].upper(), []).append(snapshot)
+        if len(snapshots) < REVALIDATE_PAGE_SIZE:
+            return reservations
+        last = snapshots[-1]
+
+
+def lookup(reservation_number, first_name, last_name):
+    """ Ask Southwest for the reservation's legs.
+    Returns:
+        list: upcoming legs, [] if the reservation is dead, or None if we couldn't tell.
+    """
+    _lookups.acquire()
+    r = Reservation(reservation_number, first_name, last_name, max_attempts=REVALIDATE_MAX_ATTEMPTS)
+    try:
+        body = r.lookup_existing_reservation()
+        if body is None:
+            # Not a reservation page at all, so no verdict either way
+            return None
+        if not body.get('bounds'):
+            return []
+        # Can fail too, e.g. an airport we can't find a timezone for
+        return upcoming_legs(body)
+    except RetriesExhausted as e:
+        if e.status in DEAD_STATUSES:
+            return []
+        print("Unable to revalidate {}: {}".format(reservation_number, e))
+        return None
+    except Exception as e:
+        print("Unable to revalidate {}: {!r}".format(reservation_number, e))
+        return None
+
+
+def reconcile(db, reservation_number, legs, now):
+    """ Work out the writes that bring a reservation's Flights in line with legs.
+    Every stored flight for the reservation is compared, not just those in
+    the scanned window, so moved legs don't leave stale documents behind.
+    Returns:
+        tuple: (writes, deletes) for gcp_clients.write_documents.
+    """
+    stored = list(db.collection(u'Flights').where(u'reservation_number', u'==', reservation_number).stream())
+    passengers = OrderedDict()
+    for snapshot in stored:
+        data = snapshot.to_dict() or {}
+        passengers[(data[u'first_name'], data[u'last_name'])] = True
+
+    wanted = OrderedDict()
+    for first_name, last_name in passengers:
+        for leg_index, flight_time, airport_code, _ in legs:
+            doc_ref, data = store_flight_information.flight_document(db, leg_index, flight_time, airport_code, reservation_number, first_name, last_name)
+            wanted[doc_ref.id] = (doc_ref, data)
+
+    writes, deletes = [], []
+    for snapshot in stored:
+        data = snapshot.to_dict() or {}
+        # Already handed to check-in, or too close to touch
+        if data.get(u'dispatched') or data.get(u'checkin_time') < now + REVALIDATE_MIN_LEAD:
+            wanted.pop(snapshot.id, None)
+            continue
+        match = wanted.pop(snapshot.id, None)
+        if match is not None:
+            # Same leg and time; only rewrite documents that need repairing,
+            # which also clears a cancelled flag or dead strikes
+            if data.get(u'cancelled') or data.get(u'dead_strikes') or u'departure_time' not in data:
+                writes.append(match)
+            continue
+        if legs:
+            # A leg that moved or was dropped
+            deletes.append(snapshot.reference)
+            continue
+        strikes = data.get(u'dead_strikes', 0) + 1
+        if strikes < REVALIDATE_DEAD_STRIKES:
+            # Not convinced yet; ask again on the next run
+            data.update({u'dead_strikes': strikes, u'revalidated_at': now})
+            writes.append((snapshot.reference, data))
+        elif REVALIDATE_DEAD_ACTION == 'delete':
+            deletes.append(snapshot.reference)
+        elif not data.get(u'cancelled'):
+            data.update({u'cancelled': True, u'dead_strikes': strikes, u'revalidated_at': now})
+            writes.append((snapshot.reference, data))
+    # Legs that moved, or were added since the email was ingested
+    writes.extend(wanted.values())
+    return writes, deletes
+
+
+def revalidate_flights(event, context):
+    started = monotonic()
+    now = datetime.utcnow().replace(tzinfo=timezone.utc)
+    db = gcp_clients.firestore_client()
+    reservations = upcoming_reservations(db, now + REVALIDATE_MIN_LEAD, now + REVALIDATE_HORIZON)
+    print("Revalidating {} reservations checking in within the next {}".format(len(reservations), REVALIDATE_HORIZON))
+
+    summary = OrderedDict((key, 0) for key in ('checked', 'unchanged', 'changed', 'dead', 'unknown', 'deferred'))
+    writes, deletes = [], []
+    try:
+        for reservation_number, snapshots in reservations.items():
+            if monotonic() - started > REVALIDATE_DEADLINE_SECONDS:
+                # Soonest check-ins went first; the rest wait for the next run
+                summary['deferred'] = len(reservations) - summary['checked']
+                break
+            summary['checked'] += 1
+            first = snapshots[0].to_dict()
+            legs = lookup(first[u'reservation_number'], first[u'first_name'], first[u'last_name'])
+            if legs is None:
+                summary['unknown'] += 1
+                continue
+            changes = reconcile(db, first[u'reservation_number'], legs, now)
+            if not legs:
+                summary['dead'] += 1
+                print("Reservation {} not found by Southwest: {} flights written, {} removed".format(reservation_number, len(changes[0]), len(changes[1])))
+            elif changes[0] or changes[1]:
+                summary['changed'] += 1
+                print("Reservation {} changed: {} flights written, {} removed".format(reservation_number, len(changes[0]), len(changes[1])))
+            else:
+                summary['unchanged'] += 1
+            writes.extend(changes[0])
+            deletes.extend(changes[1])
+    finally:
+        # One bulk commit for the whole run, even if it was cut short
+        gcp_clients.write_documents(db, writes, deletes)
+    print("Revalidated reservations: " + ", ".join("{} {}".format(count, key) for key, count in summary.items()))
+    print(gcp_clients.timing_report())
+    return "Revalidated flights."
@@ -0,0 +1,158 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+aiohttp
+requests
+"""
+
+import asyncio
+import os
+import weakref
+from collections import deque
+from datetime import datetime
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+from statistics import median
+from threading import Lock
+from time import monotonic
+from time import sleep
+from time import time
+import http_sessions
+import southwest_headers
+
+# Any cheap Southwest response carries a Date header we can calibrate against
+CALIBRATION_URL = southwest_headers.CONFIG_JS_URL
+CALIBRATION_TTL_SECONDS = float(os.environ.get('CLOCK_CALIBRATION_TTL_SECONDS', 15 * 60))
+CALIBRATION_SAMPLES = int(os.environ.get('CLOCK_CALIBRATION_SAMPLES', 5))
+MIN_SAMPLES = 3
+
+# (expires, lowest possible offset, highest possible offset, rtt) per response
+_samples = deque(maxlen=32)
+_lock = Lock()
+# One in-flight async calibration per event loop
+_inflight = weakref.WeakKeyDictionary()
+
+
+def _parse_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def record_sample(sent, received, date_header):
+    """ Add one observation of the server clock.
+    Args:
+        sent (float): Local wall clock (time.time()) when the request left.
+        received (float): Local wall clock when the response arrived.
+        date_header (str): The response's Date header.
+    """
+    server = _parse_date(date_header)
+    if server is None:
+        return
+    # Date is truncated to the second and was stamped somewhere between
+    # sending and receiving, which bounds the offset from both sides
+    lo = server - received
+    hi = server + 1 - sent
+    with _lock:
+        _samples.append((monotonic() + CALIBRATION_TTL_SECONDS, lo, hi, received - sent))
+
+
+def estimate():
+    """ Return the current server clock estimate, or None if we don't have enough fresh samples.
+    Returns:
+        dict: offset (server minus local, seconds), uncertainty (half the
+            width of the interval the offset is known to lie in), rtt
+            (seconds) and samples.
+    """
+    now = monotonic()
+    with _lock:
+        fresh = [s for s in _samples if s[0] > now]
+    if len(fresh) < MIN_SAMPLES:
+        return None
+    lo = max(s[1] for s in fresh)
+    hi = min(s[2] for s in fresh)
+    if lo <= hi:
+        offset = (lo + hi) / 2
+        uncertainty = (hi - lo) / 2
+    else:
+        # The bounds disagree (a response sat in a queue somewhere), so fall
+        # back to the middle of each sample's window
+        offset = median((s[1] + s[2]) / 2 for s in fresh)
+        uncertainty = 0.0
+    return {'offset': offset, 'uncertainty': uncertainty, 'rtt': median(s[3] for s in fresh), 'samples': len(fresh)}
+
+
+def _report(result):
+    if result is None:
+        print("Unable to calibrate against the server clock, using the local clock")
+    else:
+        print("Server clock offset {:+.1f} ms (+/- {:.1f} ms), rtt {:.1f} ms ({} samples)".format(
+            result['offset'] * 1000, result['uncertainty'] * 1000, result['rtt'] * 1000, result['samples']))
+    return result
+
+
+def calibrate(session=None, url=CALIBRATION_URL):
+    result = estimate()
+    if result is not None:
+        return result
+    session = session or http_sessions.get_session('southwest')
+    for i in range(CALIBRATION_SAMPLES):
+        if i:
+            # Spread the samples over a second so they straddle the Date
+            # header's whole-second boundaries
+            sleep(1.0 / CALIBRATION_SAMPLES)
+        sent = time()
+        try:
+            r = session.head(url)
+        except Exception as e:
+            print("Clock calibration request failed: {}".format(e))
+            continue
+        record_sample(sent, time(), r.headers.get('Date'))
+    return _report(estimate())
+
+
+async def _sample_async(session, url):
+    for i in range(CALIBRATION_SAMPLES):
+        if i:
+            await asyncio.sleep(1.0 / CALIBRATION_SAMPLES)
+        sent = time()
+        try:
+            async with session.head(url) as r:
+                record_sample(sent, time(), r.headers.get('Date'))
+        except Exception as e:
+            print("Clock calibration request failed: {}".format(e))
+    return _report(estimate())
+
+
+async def calibrate_async(session, url=CALIBRATION_URL):
+    result = estimate()
+    if result is not None:
+        return result
+    # Reservations firing together share a single calibration run
+    loop = asyncio.get_running_loop()
+    task = _inflight.get(loop)
+    if task is None or task.done():
+        task = asyncio.ensure_future(_sample_async(session, url))
+        _inflight[loop] = task
+    return await asyncio.shield(task)
+
+
+def server_utcnow():
+    # Naive UTC like datetime.utcnow(), shifted onto the server's clock
+    result = estimate()
+    offset = result['offset'] if result is not None else 0.0
+    return datetime.utcnow() + timedelta(seconds=offset)
+
+
+def lead_seconds(default):
+    # Leave early by the one-way trip time when calibrated, otherwise by
+    # default. server_utcnow() sits in the middle of the offset interval;
+    # holding back by its half-width aims at the interval's lower bound, so a
+    # wrong guess lands the request a little late rather than before the
+    # window opens. Can be negative.
+    result = estimate()
+    if result is None:
+        return default
+    return result['rtt'] / 2 - result['uncertainty']
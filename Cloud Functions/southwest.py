@@ -0,0 +1,153 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+pytz
+requests
+"""
+
+# What every Cloud Function needs to talk to Southwest. Kept free of the
+# HTTP clients themselves: the blocking Reservation here only pulls in
+# requests on its first call, and checkin_flight layers its aiohttp
+# Reservation on ReservationBase.
+
+import json
+import os
+from datetime import datetime
+from datetime import timezone
+from time import sleep
+from airports import timezone_for_airport
+import southwest_headers
+import rate_limit
+from southwest_errors import ApiKeyUnavailable
+from southwest_errors import RetriesExhausted
+
+# Point at a stand-in server (see benchmarks/mock_southwest.py) to test offline
+BASE_URL = os.environ.get('SW_BASE_URL', 'https://mobile.southwest.com/api/')
+CHECKIN_INTERVAL_SECONDS = 0.25
+MAX_ATTEMPTS = 40
+# Southwest's answers while a page isn't ready yet, or we are being
+# throttled, worth retrying
+RETRY_STATUSES = ('NOT_FOUND', 'BAD_REQUEST', 'FORBIDDEN', 'TOO_MANY_REQUESTS')
+VIEW_RESERVATION_PATH = "mobile-air-booking/v1/mobile-air-booking/page/view-reservation/"
+CHECKIN_PATH = "mobile-air-operations/v1/mobile-air-operations/page/check-in/"
+
+
+def json_page(data):
+    # Southwest wraps the interesting part of every response in a *Page key
+    if not data:
+        return
+    for k, v in list(data.items()):
+        if k.endswith("Page"):
+            return v
+
+
+def upcoming_legs(body):
+    """ Legs of a view-reservation page that haven't departed yet.
+    Returns:
+        list: (leg_index, localized departure, airport code, airport name) tuples.
+    """
+    # Get our local current time
+    now = datetime.now(timezone.utc)
+
+    legs = []
+
+    # find all eligible legs for checkin
+    for leg_index, leg in enumerate(body['bounds']):
+        # calculate departure for this leg
+        airport = "{}, {}".format(leg['departureAirport']['name'], leg['departureAirport']['state'])
+        takeoff = "{} {}".format(leg['departureDate'], leg['departureTime'])
+        airport_tz = timezone_for_airport(leg['departureAirport']['code'])
+        date = airport_tz.localize(datetime.strptime(takeoff, '%Y-%m-%d %H:%M'))
+        if date > now:
+            legs.append((leg_index, date, leg['departureAirport']['code'], airport))
+    return legs
+
+
+class ReservationBase():
+    """ URL building shared by the blocking and asyncio Reservations.
+    """
+
+    def __init__(self, number, first, last, verbose=False, base_url=None, max_attempts=None):
+        self.number = number
+        self.first = first
+        self.last = last
+        self.verbose = verbose
+        self.base_url = base_url or BASE_URL
+        # Retries before safe_request gives up on a page
+        self.max_attempts = MAX_ATTEMPTS if max_attempts is None else max_attempts
+
+    def with_suffix(self, uri):
+        return "{}{}{}?first-name={}&last-name={}".format(self.base_url, uri, self.number, self.first, self.last)
+
+    def checkin_url(self, link):
+        return "{}mobile-air-operations{}".format(self.base_url, link['href'])
+
+
+class Reservation(ReservationBase):
+
+    @staticmethod
+    def generate_headers():
+        # config.js is only fetched when the shared cache is cold or expired
+        headers = southwest_headers.get_headers()
+        if headers is None:
+            raise ApiKeyUnavailable("Couldn't get API_KEY")
+        return headers
+
+    # You might ask yourself, "Why the hell does this exist?"
+    # Basically, there sometimes appears a "hiccup" in Southwest where things
+    # aren't exactly available 24-hours before, so we try a few times
+    def safe_request(self, url, body=None):
+        import http_sessions
+        try:
+            attempts = 0
+            # Reuse warm keep-alive connections across every retry
+            session = http_sessions.get_session('southwest')
+            headers = Reservation.generate_headers()
+            while True:
+                # Every request to Southwest draws from the process-wide budget
+                rate_limit.southwest.acquire()
+                if body is not None:
+                    r = session.post(url, headers=headers, json=body)
+                else:
+                    r = session.get(url, headers=headers)
+                data = r.json()
+                if 'httpStatusCode' in data and data['httpStatusCode'] in RETRY_STATUSES:
+                    attempts += 1
+                    if data['httpStatusCode'] == 'FORBIDDEN':
+                        # Our cached API key may have been rotated
+                        southwest_headers.invalidate(headers['X-API-Key'])
+                        headers = Reservation.generate_headers()
+                    if not self.verbose:
+                        print(data['message'])
+                    else:
+                        print(r.headers)
+                        print(json.dumps(data, indent=2))
+                    if attempts > self.max_attempts:
+                        raise RetriesExhausted(url, attempts, data['httpStatusCode'], data.get('message'))
+                    sleep(rate_limit.backoff_delay(attempts, CHECKIN_INTERVAL_SECONDS))
+                    continue
+                if self.verbose:
+                    print(r.headers)
+                    print(json.dumps(data, indent=2))
+                return data
+        except ValueError:
+            # Ignore responses with no json data in body
+            pass
+
+    def load_json_page(self, url, body=None):
+        return json_page(self.safe_request(url, body))
+
+    def lookup_existing_reservation(self):
+        # Find our existing record
+        return self.load_json_page(self.with_suffix(VIEW_RESERVATION_PATH))
+
+    def get_checkin_data(self):
+        return self.load_json_page(self.with_suffix(CHECKIN_PATH))
+
+    def checkin(self):
+        data = self.get_checkin_data()
+        info_needed = data['_links']['checkIn']
+        print("Attempting check-in...")
+        confirmation = self.load_json_page(self.checkin_url(info_needed), info_needed['body'])
+        return confirmation
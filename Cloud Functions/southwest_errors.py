@@ -0,0 +1,22 @@
+class SouthwestError(Exception):
+    """ Base class for giving up on a request to Southwest.
+    Raised instead of exiting so one failing reservation never takes the
+    worker, or the reservations sharing its event loop, down with it.
+    """
+
+
+class ApiKeyUnavailable(SouthwestError):
+    pass
+
+
+class RetriesExhausted(SouthwestError):
+
+    def __init__(self, url, attempts, status, message=None):
+        super(RetriesExhausted, self).__init__("Gave up on {} after {} attempts ({}: {})".format(url, attempts, status, message))
+        self.url = url
+        self.attempts = attempts
+        self.status = status
+
+
+class DeadlineExceeded(SouthwestError):
+    pass
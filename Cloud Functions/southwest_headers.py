@@ -0,0 +1,83 @@
+#requirements.txt
+"""
+# Function dependencies, for example:
+# package>=version
+requests
+"""
+
+import os
+from threading import Lock
+from time import monotonic
+from uuid import uuid1
+import http_sessions
+
+CONFIG_JS_URL = os.environ.get('SW_CONFIG_JS_URL', 'https://mobile.southwest.com/js/config.js')
+# How long a scraped API key is trusted before config.js is fetched again
+API_KEY_TTL_SECONDS = float(os.environ.get('SW_API_KEY_TTL_SECONDS', 6 * 60 * 60))
+
+# Process-wide, so it survives across Reservation instances, threads and
+# warm Cloud Function invocations
+_cache = {'headers': None, 'expires': 0.0}
+_lock = Lock()
+
+
+def parse_api_key(config_js_text):
+    modded = config_js_text[config_js_text.index("API_KEY"):]
+    return modded[modded.index(':') + 1:modded.index(',')].strip('"')
+
+
+def build_headers(api_key):
+    USER_EXPERIENCE_KEY = str(uuid1()).upper()
+    # Pulled from proxying the Southwest iOS App. Host is left to the HTTP
+    # client, which takes it from the URL each request actually goes to.
+    return {'Content-Type': 'application/json', 'X-API-Key': api_key, 'X-User-Experience-Id': USER_EXPERIENCE_KEY, 'Accept': '*/*', 'X-Channel-ID': 'MWEB'}
+
+
+def fetch_api_key():
+    from requests import codes
+    config_js = http_sessions.get_session('southwest').get(CONFIG_JS_URL)
+    if config_js.status_code != codes.ok:
+        return None
+    return parse_api_key(config_js.text)
+
+
+def _store(api_key):
+    # Caller must hold _lock
+    headers = build_headers(api_key)
+    _cache['headers'] = headers
+    _cache['expires'] = monotonic() + API_KEY_TTL_SECONDS
+    return dict(headers)
+
+
+def cached_headers():
+    headers = _cache['headers']
+    if headers is not None and monotonic() < _cache['expires']:
+        return dict(headers)
+    return None
+
+
+def get_headers():
+    headers = cached_headers()
+    if headers is not None:
+        return headers
+    with _lock:
+        # Another thread may have refreshed the key while we waited
+        headers = cached_headers()
+        if headers is not None:
+            return headers
+        api_key = fetch_api_key()
+        if api_key is None:
+            return None
+        return _store(api_key)
+
+
+def invalidate(api_key=None):
+    # Only drop the entry if it still holds the key that was rejected, so a
+    # burst of FORBIDDEN responses triggers a single config.js refetch
+    with _lock:
+        headers = _cache['headers']
+        if headers is None:
+            return
+        if api_key is None or headers['X-API-Key'] == api_key:
+            _cache['headers'] = None
+            _cache['expires'] = 0.0
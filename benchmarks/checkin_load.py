@@ -0,0 +1,121 @@
+"""
+Load test for the check-in engine against benchmarks/mock_southwest.py.
+
+Starts the mock server in a subprocess, points the functions at it, and
+checks in N reservations concurrently on one event loop, the way
+run_checkins does. Reports how long each reservation took from the moment
+its window opened to the confirmation arriving, and what the server had to
+answer along the way. Exits non-zero if any reservation wasn't confirmed.
+
+    python benchmarks/checkin_load.py 200 --latency-ms 80 --latency-jitter-ms 40 \\
+        --window-jitter-ms 500 --not-found-seconds 1 --rate-limit 500
+
+Every mock_southwest option is accepted and passed through.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import urllib.request
+from time import sleep
+from time import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import mock_southwest
+
+
+def free_port():
+    with contextlib.closing(socket.socket()) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, argv):
+    server = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, 'mock_southwest.py'), '--port', str(port)] + argv)
+    url = 'http://127.0.0.1:{}/__stats'.format(port)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url).read()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("Mock server exited with status {}".format(server.returncode))
+            sleep(0.1)
+    server.kill()
+    raise RuntimeError("Mock server didn't start on port {}".format(port))
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[int(round(p / 100.0 * (len(ordered) - 1)))] if ordered else float('nan')
+
+
+async def run(count, verbose):
+    # Imported late so they pick up the mock's URLs from the environment
+    import checkin_flight
+    import http_sessions
+    finished = {}
+
+    async def one(job, session):
+        try:
+            deadline = checkin_flight.CHECKIN_DEADLINE_SECONDS
+            results = await checkin_flight.run_job(job, session, asyncio.get_running_loop().time() + deadline)
+            if checkin_flight.checked_in(results):
+                finished[job['reservation_number']] = time()
+        except Exception as e:
+            print("Check-in failed for {}: {!r}".format(job['reservation_number'], e), file=sys.stderr)
+
+    jobs = [{'reservation_number': "L{:05d}".format(i), 'first_name': 'Load', 'last_name': 'Test{}'.format(i)} for i in range(count)]
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        async with http_sessions.async_session() as session:
+            await asyncio.gather(*[one(job, session) for job in jobs])
+    return finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent check-in load test against the mock Southwest server.")
+    parser.add_argument('reservations', type=int, nargs='?', default=100)
+    parser.add_argument('--verbose', action='store_true', help="Show the check-in engine's output")
+    mock_southwest.add_arguments(parser)
+    parser.set_defaults(open_in=5.0)
+    args = parser.parse_args()
+
+    passthrough = []
+    for name, value in mock_southwest.server_options(args).items():
+        if value is not None:
+            passthrough += ['--' + name.replace('_', '-'), str(value)]
+
+    port = free_port()
+    server = start_server(port, passthrough)
+    try:
+        os.environ['SW_BASE_URL'] = 'http://127.0.0.1:{}/api/'.format(port)
+        os.environ['SW_CONFIG_JS_URL'] = 'http://127.0.0.1:{}/js/config.js'.format(port)
+        sys.path.insert(0, os.path.join(BENCHMARKS_DIR, os.pardir, 'Cloud Functions'))
+        finished = asyncio.run(run(args.reservations, args.verbose))
+        stats = json.loads(urllib.request.urlopen('http://127.0.0.1:{}/__stats'.format(port)).read())
+    finally:
+        server.terminate()
+        server.wait()
+
+    opened = stats['opened']
+    client = [(finished[pnr] - opened[pnr]) * 1000 for pnr in finished if pnr in opened]
+    served = [(at - opened[pnr]) * 1000 for pnr, at in stats['confirmed'].items() if pnr in opened]
+    print("{} reservations, {} confirmed".format(args.reservations, len(finished)))
+    for label, values in (("window open -> confirmation received", client), ("window open -> confirmation sent", served)):
+        print("{:<38} p50 {:8.1f} ms  p95 {:8.1f} ms  p99 {:8.1f} ms  max {:8.1f} ms".format(
+            label, percentile(values, 50), percentile(values, 95), percentile(values, 99), max(values) if values else float('nan')))
+    print("Server responses: " + ", ".join("{} {}".format(name, count) for name, count in sorted(stats['counts'].items())))
+    return 0 if len(finished) == args.reservations else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Micro-benchmark for the email classifier in email_rules.py.
+
+Runs a corpus covering every supported subject/body format through
+email_rules.classify() and reports parse throughput and per-rule hit rates.
+
+    python benchmarks/email_classifier.py [iterations]
+"""
+
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Cloud Functions'))
+
+import email_rules
+
+# (subject, body, expected (rule, fname, lname, reservation))
+CORPUS = [
+    ("(5OK3YZ) | 22APR20 | DIA-OAK | Obama/Barack", "",
+     ('legacy', 'Barack', 'Obama', '5OK3YZ')),
+    ("Fwd: (ABC123) | 01JAN21 | DAL-HOU | Smith/John", "",
+     ('legacy', 'John', 'Smith', 'ABC123')),
+    ("Here's your itinerary! (XYZ789)", "Your trip\nPASSENGER\nBarack Hussein Obama\nCheck in opens 24 hours before\n" + "x" * 2000,
+     ('itinerary', 'Barack', 'Obama', 'XYZ789')),
+    ("Southwest Airlines: Passenger Itinerary", "AIR Confirmation: QWE456 *Passenger(s)* OBAMA/BARACK W\n" + "y" * 2000,
+     ('ticketless', 'BARACK', 'OBAMA', 'QWE456')),
+    ("Barack Obama's 12/25 Oakland trip (DEF321)", "",
+     ('new', 'Barack', 'Obama', 'DEF321')),
+    ("FWD: Barack Obama's 12/25 Oakland trip (DEF321)", "",
+     ('new', 'Barack', 'Obama', 'DEF321')),
+    ("GHI654 Barack Obama", "",
+     ('manual', 'Barack', 'Obama', 'GHI654')),
+    ("Your weekly deals are here", "z" * 4000,
+     (None, None, None, None)),
+]
+
+
+def check_corpus():
+    for subject, body, expected in CORPUS:
+        parsed = tuple(email_rules.classify(subject, body))
+        if parsed != expected:
+            raise AssertionError("{!r} parsed as {} instead of {}".format(subject, parsed, expected))
+
+
+def main(iterations=20000):
+    check_corpus()
+    email_rules.hits.clear()
+    classify = email_rules.classify
+    started = perf_counter()
+    for _ in range(iterations):
+        for subject, body, _ in CORPUS:
+            classify(subject, body)
+    elapsed = perf_counter() - started
+    total = iterations * len(CORPUS)
+    print("Parsed {} emails in {:.3f}s: {:,.0f} emails/s, {:.2f} us/email".format(total, elapsed, total / elapsed, elapsed / total * 1e6))
+    for rule in [rule.name for rule in email_rules.RULES] + [None]:
+        count = email_rules.hits[rule]
+        print("  {:<12} {:>9} hits  {:6.1%}".format(rule or 'unmatched', count, count / float(total)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
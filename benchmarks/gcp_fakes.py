@@ -0,0 +1,401 @@
+"""
+In-process stand-ins for the parts of Firestore and Pub/Sub the Cloud
+Functions use, so the pipeline can be driven without GCP.
+
+Call install() before importing any function module. It registers fake
+firebase_admin, google.cloud.pubsub_v1 and google.api_core.exceptions
+modules whose clients hand back the FakeFirestore and FakePublisher given
+to it, so gcp_clients picks them up unchanged. Every document read and
+write is counted, and document creations are queued as Cloud Functions
+style trigger events.
+"""
+
+import itertools
+import sys
+import types
+from collections import Counter
+from collections import OrderedDict
+from collections import namedtuple
+from concurrent import futures
+from datetime import datetime
+from datetime import timezone
+from threading import RLock
+
+SERVER_TIMESTAMP = object()
+# Ignores whatever extra Pub/Sub options a caller passes
+BatchSettings = namedtuple('BatchSettings', ['max_bytes', 'max_latency', 'max_messages'])
+BatchSettings.__new__.__defaults__ = (1024 * 1024, 0.01, 100)
+
+
+class AlreadyExists(Exception):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+def _stored(value, now):
+    # Firestore hands timestamps back in UTC
+    if value is SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.astimezone(timezone.utc)
+    return value
+
+
+def _event_value(value):
+    # Firestore trigger payloads wrap every field in its type
+    if value is None:
+        return {'nullValue': None}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'integerValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, datetime):
+        return {'timestampValue': value.isoformat().replace('+00:00', 'Z')}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [_event_value(v) for v in value]}}
+    if isinstance(value, dict):
+        return {'mapValue': {'fields': dict((k, _event_value(v)) for k, v in value.items())}}
+    return {'stringValue': value}
+
+
+class FakeSnapshot():
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentReference():
+
+    def __init__(self, db, collection, document_id):
+        self.db = db
+        self.collection_id = collection
+        self.id = document_id
+        self.path = "{}/{}".format(collection, document_id)
+
+    def get(self, transaction=None):
+        return self.db._get(self)
+
+    def set(self, data, merge=False):
+        self.db._set(self, data, merge)
+
+    def create(self, data):
+        with self.db.lock:
+            if self.db._data(self) is not None:
+                raise AlreadyExists("Document already exists: {}".format(self.path))
+            self.db._set(self, data)
+
+    def update(self, data):
+        with self.db.lock:
+            if self.db._data(self) is None:
+                raise NotFound("No document to update: {}".format(self.path))
+            self.db._set(self, data, merge=True)
+
+    def delete(self):
+        self.db._delete(self)
+
+
+class FakeQuery():
+    """ where/order_by/limit/start_after/stream, as check_for_flights uses them.
+    """
+
+    OPERATORS = {
+        '==': lambda a, b: a == b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+    }
+
+    def __init__(self, db, collection, filters=(), order=None, limit_to=None, after=None):
+        self.db = db
+        self.collection_id = collection
+        self.filters = filters
+        self.order = order
+        self.limit_to = limit_to
+        self.after = after
+
+    def _copy(self, **changes):
+        fields = dict(filters=self.filters, order=self.order, limit_to=self.limit_to, after=self.after)
+        fields.update(changes)
+        return FakeQuery(self.db, self.collection_id, **fields)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self.filters + ((field, self.OPERATORS[op], value),))
+
+    def order_by(self, field):
+        return self._copy(order=field)
+
+    def limit(self, count):
+        return self._copy(limit_to=count)
+
+    def start_after(self, snapshot):
+        return self._copy(after=snapshot)
+
+    def stream(self):
+        with self.db.lock:
+            documents = list(self.db.collections.get(self.collection_id, {}).items())
+        matches = []
+        for document_id, data in documents:
+            # Like Firestore, documents missing a filtered field never match
+            if all(field in data and test(data[field], value) for field, test, value in self.filters):
+                matches.append((document_id, data))
+        if self.order is not None:
+            matches = [m for m in matches if self.order in m[1]]
+            matches.sort(key=lambda m: (m[1][self.order], m[0]))
+        if self.after is not None:
+            ids = [document_id for document_id, _ in matches]
+            if self.after.id in ids:
+                matches = matches[ids.index(self.after.id) + 1:]
+        if self.limit_to is not None:
+            matches = matches[:self.limit_to]
+        # Billed one read per document returned, and one for an empty result
+        self.db.count('reads', max(len(matches), 1))
+        return iter([FakeSnapshot(FakeDocumentReference(self.db, self.collection_id, document_id), dict(data)) for document_id, data in matches])
+
+
+class FakeCollection(FakeQuery):
+
+    def __init__(self, db, collection):
+        super(FakeCollection, self).__init__(db, collection)
+        self.id = collection
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = "auto-{}".format(next(self.db.ids))
+        return FakeDocumentReference(self.db, self.id, document_id)
+
+
+class FakeWriteBatch():
+
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes.append((doc_ref, data, merge))
+
+    def update(self, doc_ref, data):
+        self.writes.append((doc_ref, data, 'update'))
+
+    def delete(self, doc_ref):
+        self.writes.append((doc_ref, None, False))
+
+    def commit(self):
+        with self.db.lock:
+            for doc_ref, data, merge in self.writes:
+                if data is None:
+                    doc_ref.delete()
+                elif merge == 'update':
+                    doc_ref.update(data)
+                else:
+                    doc_ref.set(data, merge)
+        self.db.count('commits')
+        self.writes = []
+
+
+class FakeBulkWriter(FakeWriteBatch):
+
+    def close(self):
+        self.commit()
+
+
+class FakeTransaction():
+    # Writes are applied when the transactional function returns
+
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes.append((doc_ref.set, data, merge))
+
+    def update(self, doc_ref, data):
+        self.writes.append((lambda data, merge: doc_ref.update(data), data, True))
+
+    def commit(self):
+        for write, data, merge in self.writes:
+            write(data, merge)
+        self.db.count('commits')
+        self.writes = []
+
+
+def transactional(to_wrap):
+    # One global lock stands in for Firestore's optimistic concurrency
+    def wrapper(transaction, *args, **kwargs):
+        with transaction.db.lock:
+            result = to_wrap(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return wrapper
+
+
+class FakeFirestore():
+    """ A single in-memory database.
+    Attributes:
+        counts (Counter): reads, writes, deletes and commits so far.
+        events (dict): collection -> pending (data, context) create triggers.
+    """
+
+    def __init__(self, triggers=()):
+        self.collections = {}
+        self.counts = Counter()
+        self.triggers = set(triggers)
+        self.events = dict((collection, []) for collection in self.triggers)
+        self.ids = itertools.count()
+        self.lock = RLock()
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def bulk_writer(self):
+        return FakeBulkWriter(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def get_all(self, references):
+        for doc_ref in references:
+            yield self._get(doc_ref)
+
+    def _data(self, doc_ref):
+        return self.collections.get(doc_ref.collection_id, {}).get(doc_ref.id)
+
+    def _get(self, doc_ref):
+        self.count('reads')
+        with self.lock:
+            data = self._data(doc_ref)
+            return FakeSnapshot(doc_ref, dict(data) if data is not None else None)
+
+    def _set(self, doc_ref, data, merge=False):
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            documents = self.collections.setdefault(doc_ref.collection_id, OrderedDict())
+            existing = documents.get(doc_ref.id)
+            stored = dict(existing) if merge and existing is not None else {}
+            for field, value in data.items():
+                stored[field] = _stored(value, now)
+            documents[doc_ref.id] = stored
+            self.count('writes')
+            if existing is None and doc_ref.collection_id in self.triggers:
+                self.events[doc_ref.collection_id].append(self._event(doc_ref, stored, now))
+
+    def _delete(self, doc_ref):
+        with self.lock:
+            self.collections.get(doc_ref.collection_id, {}).pop(doc_ref.id, None)
+        self.count('deletes')
+
+    def _event(self, doc_ref, data, now):
+        fields = dict((field, _event_value(value)) for field, value in data.items())
+        context = types.SimpleNamespace(
+            event_id=str(next(self.ids)),
+            timestamp=now.isoformat(),
+            event_type='providers/cloud.firestore/eventTypes/document.create',
+            resource='projects/_/databases/(default)/documents/' + doc_ref.path)
+        return {'oldValue': {}, 'value': {'name': context.resource, 'fields': fields}}, context
+
+    def take_events(self, collection):
+        # Hand over the create triggers queued so far for collection
+        with self.lock:
+            events, self.events[collection] = self.events[collection], []
+        return events
+
+    def documents(self, collection):
+        with self.lock:
+            return dict((k, dict(v)) for k, v in self.collections.get(collection, {}).items())
+
+
+class FakePublisher():
+    """ Publishes by appending to an in-memory topic; every future is already resolved.
+    """
+
+    def __init__(self, batch_settings=None):
+        self.batch_settings = batch_settings
+        self.topics = {}
+        self.ids = itertools.count(1)
+        self.lock = RLock()
+
+    @staticmethod
+    def topic_path(project, topic):
+        return "projects/{}/topics/{}".format(project, topic)
+
+    def publish(self, topic, data, **attributes):
+        if not isinstance(data, bytes):
+            raise TypeError("Data being published to Pub/Sub must be sent as a bytestring.")
+        future = futures.Future()
+        with self.lock:
+            message_id = str(next(self.ids))
+            self.topics.setdefault(topic, []).append((message_id, data, attributes))
+        future.set_result(message_id)
+        return future
+
+    def take_messages(self, topic):
+        with self.lock:
+            messages, self.topics[topic] = self.topics.get(topic, []), []
+        return messages
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    _attach(name, module)
+    return module
+
+
+def _package(name):
+    # Reuse real namespace packages so unrelated google.* imports keep working
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        module.__path__ = []
+        sys.modules[name] = module
+        _attach(name, module)
+    return module
+
+
+def _attach(name, module):
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+
+def install(db=None, publisher=None):
+    """ Register the fake client modules and return (db, publisher).
+    Must run before the function modules are imported, since they bind
+    firestore.transactional at import time.
+    """
+    db = db if db is not None else FakeFirestore()
+    publisher = publisher if publisher is not None else FakePublisher()
+    firestore = types.SimpleNamespace(
+        client=lambda app=None: db, transactional=transactional, SERVER_TIMESTAMP=SERVER_TIMESTAMP)
+    _module('firebase_admin', _apps={'[DEFAULT]': object()}, initialize_app=lambda *args, **kwargs: None)
+    _module('firebase_admin.firestore', **vars(firestore))
+    _module('firebase_admin.credentials')
+    _package('google')
+    _package('google.cloud')
+    _module('google.cloud.pubsub_v1',
+            PublisherClient=lambda batch_settings=None: publisher,
+            types=types.SimpleNamespace(BatchSettings=BatchSettings))
+    _package('google.api_core')
+    _module('google.api_core.exceptions', AlreadyExists=AlreadyExists, NotFound=NotFound)
+    return db, publisher
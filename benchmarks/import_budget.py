@@ -0,0 +1,97 @@
+"""
+Cold-start import budget for each Cloud Function entry point.
+
+Imports every entry point in a fresh interpreter under `python -X importtime`
+and reports its total import time and the most expensive imports, exiting
+non-zero if any entry point goes over its budget or fails to import.
+
+    python benchmarks/import_budget.py [budget_ms] [top]
+
+The budget defaults to IMPORT_BUDGET_MS; per-entry overrides come from
+IMPORT_BUDGET_MS_<ENTRY>, e.g. IMPORT_BUDGET_MS_CHECKIN_FLIGHT=150.
+"""
+
+import os
+import subprocess
+import sys
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Cloud Functions')
+
+# Module file for every deployed function, plus the long-running worker
+ENTRY_POINTS = (
+    'check_for_flights.py',
+    'checkin_flight.py',
+    'store_flight_information.py',
+    'sw-email-ingestion.py',
+    'revalidate_flights.py',
+    'checkin_worker.py',
+)
+DEFAULT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 300))
+MARKER = '-- entry point --'
+
+# Loads the module by path, since sw-email-ingestion.py isn't a valid module name
+IMPORT_SNIPPET = """
+import importlib.util, sys
+sys.path.insert(0, {directory!r})
+# Everything after the marker was imported by the entry point itself
+sys.stderr.write({marker!r} + '\\n')
+sys.stderr.flush()
+spec = importlib.util.spec_from_file_location('entry_point', {path!r})
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+"""
+
+
+def budget_for(entry, default):
+    name = os.path.splitext(entry)[0].replace('-', '_').upper()
+    return float(os.environ.get('IMPORT_BUDGET_MS_' + name, default))
+
+
+def parse_importtime(stderr):
+    # (cumulative us, depth, module) for every line -X importtime wrote
+    imports = []
+    lines = stderr.splitlines()
+    if MARKER in lines:
+        lines = lines[lines.index(MARKER) + 1:]
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|', 2)
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((int(cumulative), depth, module.strip()))
+    return imports
+
+
+def measure(entry):
+    directory = os.path.abspath(FUNCTIONS_DIR)
+    snippet = IMPORT_SNIPPET.format(directory=directory, path=os.path.join(directory, entry), marker=MARKER)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', snippet], capture_output=True, text=True, cwd=directory)
+    if result.returncode != 0:
+        lines = [line for line in result.stderr.splitlines() if not line.startswith('import time:') and line != MARKER]
+        return None, lines[-1] if lines else "exit status {}".format(result.returncode)
+    return parse_importtime(result.stderr), None
+
+
+def main(budget_ms=None, top=5):
+    budget_ms = DEFAULT_BUDGET_MS if budget_ms is None else budget_ms
+    failures = 0
+    for entry in ENTRY_POINTS:
+        budget = budget_for(entry, budget_ms)
+        imports, error = measure(entry)
+        if imports is None:
+            failures += 1
+            print("{:<30} FAILED  {}".format(entry, error))
+            continue
+        # Top-level imports sum to what the entry point itself costs
+        total_ms = sum(cumulative for cumulative, depth, _ in imports if depth == 0) / 1000.0
+        status = 'ok' if total_ms <= budget else 'OVER'
+        if status != 'ok':
+            failures += 1
+        print("{:<30} {:8.1f} ms  budget {:6.0f} ms  {}".format(entry, total_ms, budget, status))
+        for cumulative, _, module in sorted(imports, reverse=True)[:top]:
+            print("    {:<40} {:8.1f} ms".format(module, cumulative / 1000.0))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    sys.exit(main(float(args[0]) if args else None, *[int(arg) for arg in args[1:]]))
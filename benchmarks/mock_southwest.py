@@ -0,0 +1,221 @@
+"""
+Local stand-in for the parts of mobile.southwest.com the check-in engine uses.
+
+Serves config.js, view-reservation, the check-in page and the check-in POST
+for any confirmation number. Every reservation departs from PHX on the same
+minute, and its check-in window opens 24 hours before that, give or take a
+per-reservation jitter. The server can be made slow and unreliable:
+
+  * --latency-ms / --latency-jitter-ms   delay every response
+  * --window-jitter-ms                   open windows early or late
+  * --not-found-seconds                  NOT_FOUND for a while after opening
+  * --rotate-key-at                      rotate the API key, so the old one gets FORBIDDEN
+  * --rate-limit / --burst               answer 429 TOO_MANY_REQUESTS when over budget
+
+Point the functions at it with SW_BASE_URL=http://127.0.0.1:8765/api/ and
+SW_CONFIG_JS_URL=http://127.0.0.1:8765/js/config.js. GET /__stats returns when
+each window opened and when each reservation was confirmed.
+
+    python benchmarks/mock_southwest.py --port 8765 --open-in 30
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import zlib
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from email.utils import formatdate
+from time import monotonic
+from time import time
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Cloud Functions'))
+
+import airports
+
+AIRPORT = 'PHX'
+VIEW_RESERVATION = '/api/mobile-air-booking/v1/mobile-air-booking/page/view-reservation/{pnr}'
+CHECKIN_PAGE = '/api/mobile-air-operations/v1/mobile-air-operations/page/check-in/{pnr}'
+CHECKIN = '/api/mobile-air-operations/v1/mobile-air-operations/page/check-in'
+
+
+class MockSouthwest():
+
+    def __init__(self, open_in=30.0, latency_ms=0.0, latency_jitter_ms=0.0, window_jitter_ms=0.0,
+                 not_found_seconds=0.0, rotate_key_at=None, rate_limit=None, burst=None, seed=None):
+        self.random = random.Random(seed)
+        self.latency = latency_ms / 1000.0
+        self.latency_jitter = latency_jitter_ms / 1000.0
+        self.window_jitter = window_jitter_ms / 1000.0
+        self.not_found_seconds = not_found_seconds
+        # Departure on the first whole minute at least open_in seconds away,
+        # since Southwest only shows departures to the minute
+        nominal = datetime.now(timezone.utc) + timedelta(seconds=open_in, minutes=1)
+        self.nominal_open = nominal.replace(second=0, microsecond=0)
+        self.departure = (self.nominal_open + timedelta(days=1)).astimezone(airports.timezone_for_airport(AIRPORT))
+        self.api_key = 'mock-key-1'
+        self.rotate_key_at = rotate_key_at
+        self.rate_limit = rate_limit
+        self.burst = burst or rate_limit
+        self.tokens = self.burst
+        self.refilled = monotonic()
+        self.counts = Counter()
+        # PNR -> wall clock time its window opened / it was confirmed
+        self.opened = {}
+        self.confirmed = {}
+        self.boarding = 0
+
+    def opens_at(self, pnr):
+        # Stable per reservation, so every request sees the same window
+        jitter = zlib.crc32(pnr.encode('utf-8')) / float(0xffffffff) * 2 - 1
+        return self.nominal_open.timestamp() + jitter * self.window_jitter
+
+    def current_key(self):
+        if self.rotate_key_at is not None and time() >= self.nominal_open.timestamp() + self.rotate_key_at:
+            return 'mock-key-2'
+        return self.api_key
+
+    def throttled(self):
+        if not self.rate_limit:
+            return False
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate_limit)
+        self.refilled = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    async def respond(self, request, data=None, status=200, text=None):
+        delay = self.latency + self.random.uniform(-self.latency_jitter, self.latency_jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        headers = {'Date': formatdate(usegmt=True)}
+        if text is not None:
+            return web.Response(text=text, status=status, headers=headers)
+        return web.json_response(data, status=status, headers=headers)
+
+    def error(self, kind, message, status):
+        self.counts[kind] += 1
+        return {'httpStatusCode': kind, 'message': message}, status
+
+    def guard(self, request):
+        # Throttling and key checks shared by every API endpoint
+        if self.throttled():
+            return self.error('TOO_MANY_REQUESTS', "Too many requests", 429)
+        if request.headers.get('X-API-Key') != self.current_key():
+            return self.error('FORBIDDEN', "Invalid API key", 403)
+        return None
+
+    def window(self, pnr):
+        # Errors a reservation gets before and just after its window opens
+        opens_at = self.opens_at(pnr)
+        now = time()
+        if now < opens_at:
+            return self.error('BAD_REQUEST', "Check-in is not available yet", 400)
+        self.opened.setdefault(pnr, opens_at)
+        if now < opens_at + self.not_found_seconds:
+            return self.error('NOT_FOUND', "Reservation not found", 404)
+        return None
+
+    async def config_js(self, request):
+        self.counts['config.js'] += 1
+        return await self.respond(request, text='var config = {{API_KEY:"{}",APP_ID:"swa"}}'.format(self.current_key()))
+
+    async def head(self, request):
+        return await self.respond(request, text='')
+
+    async def view_reservation(self, request):
+        failure = self.guard(request)
+        if failure:
+            return await self.respond(request, *failure)
+        self.counts['view-reservation'] += 1
+        bound = {
+            'departureAirport': {'name': 'Phoenix', 'state': 'AZ', 'code': AIRPORT},
+            'departureDate': self.departure.strftime('%Y-%m-%d'),
+            'departureTime': self.departure.strftime('%H:%M'),
+        }
+        return await self.respond(request, {'viewReservationViewPage': {'bounds': [bound]}})
+
+    async def checkin_page(self, request):
+        pnr = request.match_info['pnr']
+        failure = self.guard(request) or self.window(pnr)
+        if failure:
+            return await self.respond(request, *failure)
+        self.counts['check-in page'] += 1
+        link = {'href': '/v1/mobile-air-operations/page/check-in', 'body': {
+            'recordLocator': pnr, 'firstName': request.query.get('first-name'), 'lastName': request.query.get('last-name')}}
+        return await self.respond(request, {'checkInViewReservationPage': {'_links': {'checkIn': link}}})
+
+    async def checkin(self, request):
+        body = await request.json()
+        pnr = body['recordLocator']
+        failure = self.guard(request) or self.window(pnr)
+        if failure:
+            return await self.respond(request, *failure)
+        self.counts['check-in'] += 1
+        if pnr not in self.confirmed:
+            self.boarding += 1
+        position = self.boarding
+        response = await self.respond(request, {'checkInConfirmationPage': {'flights': [{'passengers': [{
+            'name': "{} {}".format(body['firstName'], body['lastName']),
+            'boardingGroup': 'ABC'[min(position - 1, 179) // 60], 'boardingPosition': str((position - 1) % 60 + 1)}]}]}})
+        self.confirmed.setdefault(pnr, time())
+        return response
+
+    async def stats(self, request):
+        return web.json_response({
+            'nominal_open': self.nominal_open.timestamp(),
+            'opened': self.opened,
+            'confirmed': self.confirmed,
+            'counts': self.counts,
+        })
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/js/config.js', self.config_js, allow_head=False)
+        app.router.add_get(VIEW_RESERVATION, self.view_reservation)
+        app.router.add_get(CHECKIN_PAGE, self.checkin_page)
+        app.router.add_post(CHECKIN, self.checkin)
+        app.router.add_get('/__stats', self.stats)
+        app.router.add_route('HEAD', '/{tail:.*}', self.head)
+        return app
+
+
+def add_arguments(parser):
+    parser.add_argument('--open-in', type=float, default=30.0, help="Seconds until the windows open, rounded up to a whole minute")
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--window-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--not-found-seconds', type=float, default=0.0)
+    parser.add_argument('--rotate-key-at', type=float, default=None, help="Seconds after the nominal opening")
+    parser.add_argument('--rate-limit', type=float, default=None, help="Requests per second before answering 429")
+    parser.add_argument('--burst', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def server_options(args):
+    return dict((name, getattr(args, name)) for name in (
+        'open_in', 'latency_ms', 'latency_jitter_ms', 'window_jitter_ms', 'not_found_seconds',
+        'rotate_key_at', 'rate_limit', 'burst', 'seed'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Southwest mobile API for offline check-in testing.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    mock = MockSouthwest(**server_options(args))
+    print("Windows open at {} (departure {} from {})".format(mock.nominal_open.isoformat(), mock.departure.isoformat(), AIRPORT), flush=True)
+    web.run_app(mock.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
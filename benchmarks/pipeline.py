@@ -0,0 +1,336 @@
+"""
+End-to-end benchmark of the check-in pipeline against in-process fakes.
+
+Synthetic confirmation emails (with redeliveries and forwards mixed in) go
+through every stage the deployed functions run:
+
+    on_incoming_message -> Reservations -> retrieve_from_firestore -> Flights
+        -> find_flights -> Pub/Sub -> checkin_flight
+
+Firestore and Pub/Sub come from gcp_fakes; Southwest is a canned responder
+behind http_sessions. Each stage reports throughput, per-call latency
+percentiles, Firestore document reads/writes and Southwest requests, and
+the run fails if any reservation doesn't come out the other end checked in.
+
+    python benchmarks/pipeline.py [reservations]
+
+The Southwest rate limit is lifted unless SW_RATE_LIMIT_PER_SECOND is set.
+"""
+
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from email.utils import formatdate
+from time import perf_counter
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Cloud Functions')
+sys.path.insert(0, FUNCTIONS_DIR)
+os.environ.setdefault('SW_RATE_LIMIT_PER_SECOND', '1000000')
+os.environ.setdefault('SW_RATE_LIMIT_BURST', '1000000')
+os.environ.setdefault('AIRPORT_TZ_REMOTE_FALLBACK', 'false')
+
+import gcp_fakes
+
+db, publisher = gcp_fakes.install(gcp_fakes.FakeFirestore(triggers=[u'Reservations']))
+
+import airports
+import check_for_flights
+import checkin_flight
+import http_sessions
+import server_clock
+import store_flight_information
+
+
+def _load(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(FUNCTIONS_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+sw_email_ingestion = _load('sw-email-ingestion.py', 'sw_email_ingestion')
+
+AIRPORTS = ('ATL', 'BWI', 'DAL', 'DEN', 'HOU', 'LAS', 'MDW', 'OAK', 'PHX', 'SEA')
+FIRST_NAMES = ('Barack', 'Michelle', 'Sasha', 'Malia', 'Joe', 'Jill', 'Kamala', 'Doug')
+LAST_NAMES = ('Obama', 'Biden', 'Harris', 'Emhoff', 'Robinson', 'Jacobs')
+# Every Nth email is redelivered as is, every Mth forwarded by the passenger
+REDELIVER_EVERY = 10
+FORWARD_EVERY = 25
+
+
+class _SyncResponse():
+
+    def __init__(self, status, data=None, text='', headers=None):
+        self.status_code = self.status = status
+        self.headers = headers or {}
+        self._data = data
+        self.text = text if data is None else json.dumps(data)
+
+    def json(self, **kwargs):
+        if self._data is None:
+            raise ValueError("No JSON body")
+        return self._data
+
+
+class _AsyncResponse(_SyncResponse):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def json(self, content_type=None):
+        return _SyncResponse.json(self)
+
+
+class _AsyncCall():
+    # Awaitable and usable as `async with`, like aiohttp's request context
+
+    def __init__(self, response):
+        self.response = response
+
+    def __await__(self):
+        yield from []
+        return self.response
+
+    async def __aenter__(self):
+        return self.response
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSouthwest():
+    """ Canned mobile.southwest.com responses for a fixed set of reservations.
+    Serves config.js, view-reservation, the check-in page and the check-in
+    POST, through both the requests and the aiohttp session interfaces.
+    """
+
+    def __init__(self):
+        # PNR -> [(airport code, local departure)]
+        self.reservations = {}
+        self.counts = Counter()
+        self.boarding = Counter()
+
+    def _respond(self, method, url, body=None):
+        self.counts['requests'] += 1
+        parts = urlsplit(url)
+        headers = {'Date': formatdate(usegmt=True)}
+        if method == 'HEAD':
+            self.counts['head'] += 1
+            return 200, None, '', headers
+        if parts.path.endswith('config.js'):
+            self.counts['config.js'] += 1
+            return 200, None, 'var config = {API_KEY:"benchmark-key",APP_ID:"swa"}', headers
+        query = parse_qs(parts.query)
+        if '/view-reservation/' in parts.path:
+            self.counts['view-reservation'] += 1
+            pnr = parts.path.rsplit('/', 1)[-1]
+            legs = self.reservations.get(pnr)
+            if legs is None:
+                return 200, {'httpStatusCode': 'NOT_FOUND', 'message': 'No reservation'}, '', headers
+            bounds = [{
+                'departureAirport': {'name': code, 'state': 'XX', 'code': code},
+                'departureDate': local.strftime('%Y-%m-%d'),
+                'departureTime': local.strftime('%H:%M'),
+            } for code, local in legs]
+            return 200, {'viewReservationViewPage': {'bounds': bounds}}, '', headers
+        if method == 'GET':
+            self.counts['check-in page'] += 1
+            pnr = parts.path.rsplit('/', 1)[-1]
+            link = {'href': '/v1/mobile-air-operations/page/check-in', 'body': {
+                'recordLocator': pnr, 'firstName': query['first-name'][0], 'lastName': query['last-name'][0]}}
+            return 200, {'checkInViewReservationPage': {'_links': {'checkIn': link}}}, '', headers
+        self.counts['check-in'] += 1
+        self.boarding[body['recordLocator']] += 1
+        passenger = {'name': "{} {}".format(body['firstName'], body['lastName']), 'boardingGroup': 'A',
+                     'boardingPosition': str(len(self.boarding) % 60 + 1)}
+        return 200, {'checkInConfirmationPage': {'flights': [{'passengers': [passenger]}]}}, '', headers
+
+    # requests.Session interface
+
+    def get(self, url, headers=None, **kwargs):
+        return _SyncResponse(*self._respond('GET', url))
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        return _SyncResponse(*self._respond('POST', url, json))
+
+    def head(self, url, **kwargs):
+        return _SyncResponse(*self._respond('HEAD', url))
+
+    # aiohttp.ClientSession interface
+
+    def async_session(self):
+        return _FakeClientSession(self)
+
+
+class _FakeClientSession():
+
+    def __init__(self, southwest):
+        self.southwest = southwest
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def get(self, url, headers=None, **kwargs):
+        return _AsyncCall(_AsyncResponse(*self.southwest._respond('GET', url)))
+
+    def post(self, url, headers=None, json=None, **kwargs):
+        return _AsyncCall(_AsyncResponse(*self.southwest._respond('POST', url, json)))
+
+    def head(self, url, **kwargs):
+        return _AsyncCall(_AsyncResponse(*self.southwest._respond('HEAD', url)))
+
+
+class FakeRequest():
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get_json(self):
+        return self.payload
+
+
+def _base36(number):
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'[digit] + digits
+        if not number:
+            return digits
+
+
+def synthetic_reservations(count):
+    # Outbound leg checking in within the last hour, return leg days later
+    now = datetime.utcnow()
+    reservations = []
+    for i in range(count):
+        pnr = "Q" + _base36(i).rjust(5, '0')
+        first, last = FIRST_NAMES[i % len(FIRST_NAMES)], LAST_NAMES[i // len(FIRST_NAMES) % len(LAST_NAMES)]
+        outbound, inbound = AIRPORTS[i % len(AIRPORTS)], AIRPORTS[(i + 3) % len(AIRPORTS)]
+        departs = now + timedelta(hours=23, minutes=5 + i % 50)
+        legs = []
+        for code, utc in ((outbound, departs), (inbound, departs + timedelta(days=3))):
+            local = airports.timezone_for_airport(code).fromutc(utc.replace(microsecond=0))
+            legs.append((code, local.replace(tzinfo=None)))
+        reservations.append((pnr, first, last, legs))
+    return reservations
+
+
+def synthetic_emails(reservations):
+    emails = []
+    for i, (pnr, first, last, legs) in enumerate(reservations):
+        subject = (
+            "{} {} {}".format(pnr, first, last),
+            "{} {}'s {} trip ({})".format(first, last, legs[0][0], pnr),
+            "({}) | 22APR20 | {}-{} | {}/{}".format(pnr, legs[0][0], legs[1][0], last, first),
+        )[i % 3]
+        copies = [subject]
+        if i % REDELIVER_EVERY == 0:
+            copies.append(subject)
+        if i % FORWARD_EVERY == 0:
+            copies.append("Fwd: " + subject)
+        for copy in copies:
+            emails.append({
+                'headers': {'subject': copy, 'from': "{}.{}@example.com".format(first, last).lower()},
+                'plain': "Your trip is booked.\n" + "Details " * 400,
+                'html': "<p>Your trip is booked.</p>" * 400,
+                'attachments': [{'file_name': 'itinerary.pdf', 'content': 'x' * 2048}],
+            })
+    return emails
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[int(round(p / 100.0 * (len(ordered) - 1)))] if ordered else 0.0
+
+
+def run_stage(name, items, handler, southwest, units=None):
+    """ Call handler once per item with its output discarded.
+    Returns:
+        dict: units processed, elapsed seconds, latency percentiles and the
+            Firestore and Southwest traffic the stage caused.
+    """
+    reads, writes, requests = db.counts['reads'], db.counts['writes'], southwest.counts['requests']
+    latencies = []
+    started = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for item in items:
+            call_started = perf_counter()
+            handler(item)
+            latencies.append(perf_counter() - call_started)
+    elapsed = perf_counter() - started
+    count = len(items) if units is None else units()
+    return {
+        'stage': name, 'units': count, 'seconds': elapsed,
+        'per_second': count / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'reads': db.counts['reads'] - reads, 'writes': db.counts['writes'] - writes,
+        'southwest': southwest.counts['requests'] - requests,
+    }
+
+
+def main(count=1000):
+    southwest = FakeSouthwest()
+    http_sessions.get_session = lambda name='default': southwest
+    http_sessions.async_session = southwest.async_session
+
+    reservations = synthetic_reservations(count)
+    for pnr, _, _, legs in reservations:
+        southwest.reservations[pnr] = legs
+    emails = [FakeRequest(payload) for payload in synthetic_emails(reservations)]
+    # Calibrating sleeps for about a second, which would swamp the dispatch stage
+    with contextlib.redirect_stdout(io.StringIO()):
+        server_clock.calibrate()
+
+    stats = []
+    stats.append(run_stage('email', emails, sw_email_ingestion.on_incoming_message, southwest))
+
+    events = db.take_events(u'Reservations')
+    stats.append(run_stage('store', events, lambda event: store_flight_information.retrieve_from_firestore(*event), southwest))
+
+    # The synthetic check-ins are already due, so start from a watermark an
+    # hour back, as a dispatcher that has been ticking all along would have;
+    # the first tick of a fresh deployment doesn't catch up
+    watermark = db.collection(check_for_flights.DISPATCHER_COLLECTION).document(check_for_flights.DISPATCHER_DOCUMENT)
+    watermark.set({u'high_water_mark': server_clock.server_utcnow().replace(tzinfo=timezone.utc) - timedelta(hours=1)})
+    tick = {'data': base64.b64encode(json.dumps({'reservation_number': 'Priming'}).encode('utf-8'))}
+    published = lambda: sum(len(messages) for messages in publisher.topics.values())
+    stats.append(run_stage('dispatch', [tick], lambda event: check_for_flights.find_flights(event, None), southwest, published))
+
+    messages = [message for topic in list(publisher.topics) for message in publisher.take_messages(topic)]
+    jobs = [{'data': base64.b64encode(data)} for _, data, _ in messages]
+    stats.append(run_stage('checkin', jobs, lambda event: checkin_flight.checkin_flight(event, None), southwest))
+
+    print("{} reservations, {} emails".format(count, len(emails)))
+    print("{:<9} {:>7} {:>8} {:>10} {:>9} {:>9} {:>9} {:>7} {:>7} {:>9}".format(
+        'stage', 'units', 'seconds', 'units/s', 'p50 ms', 'p95 ms', 'p99 ms', 'reads', 'writes', 'southwest'))
+    for stage in stats:
+        print("{stage:<9} {units:>7} {seconds:>8.2f} {per_second:>10,.0f} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f} {reads:>7} {writes:>7} {southwest:>9}".format(**stage))
+
+    stored = len(db.documents(u'Reservations'))
+    flights = len(db.documents(u'Flights'))
+    checked_in = len(southwest.boarding)
+    print("Stored {} reservations and {} flights, checked in {} reservations".format(stored, flights, checked_in))
+    if stored != count or flights != 2 * count or checked_in != count:
+        raise AssertionError("Pipeline lost reservations: expected {} stored, {} flights and {} check-ins".format(count, 2 * count, count))
+    return stats
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])